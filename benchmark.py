@@ -0,0 +1,438 @@
+"""
+Benchmark of the stages of convert_dir on a synthetic corpus
+The corpus is generated offline from a seed with varying piece lengths, polyphony, instrument counts and tempo changes,
+every stage runs in its own process so its time and peak memory are measured separately
+The startup mode measures how long the commands of cli.py take to show their help
+The results are written to a JSON file, --compare prints the speedup against the results of an earlier run
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import time
+from functools import partial
+from typing import List, Dict, Tuple
+
+import click
+import numpy as np
+
+import common
+from cache import Cache, format_size
+import check_satb as check
+import cli
+import convert_dir as convert
+import process_midi as process
+from metrics import get_peak_memory
+
+BENCHMARK_VERSION = 1
+CORPUS_NAME = "synthetic"
+CORPUS_INFO_FILE = "corpus.json"
+MODES = ["disk", "fused", "windows", "startup"]
+CLI_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+STARTUP_RUNS = 5
+# the help of the group and the commands working on files alone have to start within the target,
+# the others load numpy and pretty_midi and are only measured
+STARTUP_TARGET = 0.1
+STARTUP_TARGET_COMMANDS = ["separate_midis", "corpus_index"]
+
+RESOLUTION = 480
+TEMPO_RANGE = (60, 160)
+VELOCITY_RANGE = (40, 110)
+NOTE_BEATS = [0.5, 1, 1, 1, 1.5, 2]
+REST_PROBABILITY = 0.1
+# instruments past the four voices play over the whole range, so they push pieces over the note count
+VOICE_RANGES = [voice_range for _, voice_range in check.RANGE_VOICES]
+WIDE_RANGE = (36, 96)
+
+
+def get_tempo_track(rng: random.Random, tick_count: int, tempo_changes: int) -> bytes:
+    data = b"\x00\xff\x58\x04\x04\x02\x18\x08"
+    last_tick = 0
+    for tick in [0] + sorted(rng.randrange(tick_count) for _ in range(tempo_changes)):
+        tempo = int(6e7 / rng.uniform(*TEMPO_RANGE))
+        data += common.encode_variable_int(tick - last_tick) + b"\xff\x51\x03" + struct.pack(">L", tempo)[1:]
+        last_tick = tick
+    data += b"\x01\xff\x2f\x00"
+    return common.get_midi_chunk(b"MTrk", data)
+
+
+def get_voice_notes(rng: random.Random, tick_count: int, polyphony: int,
+                    pitch_range: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    pitches = []
+    velocities = []
+    starts = []
+    tick = 0
+    while tick < tick_count:
+        length = int(rng.choice(NOTE_BEATS) * RESOLUTION)
+        if rng.random() >= REST_PROBABILITY:
+            for pitch in rng.sample(range(pitch_range[0], pitch_range[1] + 1), polyphony):
+                pitches.append(pitch)
+                velocities.append(rng.randint(*VELOCITY_RANGE))
+                starts.append((tick, length))
+        tick += length
+    spans = np.array(starts, dtype=np.int64).reshape((-1, 2))
+    # a short gap between following notes, so legato notes are not counted twice in the analysis
+    return (np.array(pitches, dtype=np.int64), np.array(velocities, dtype=np.int64),
+            spans[:, 0], spans[:, 0] + spans[:, 1] - RESOLUTION // 8)
+
+
+def generate_piece(rng: random.Random, length: float, polyphony: int, instrument_count: int,
+                   tempo_changes: int) -> bytes:
+    tick_count = int(length * sum(TEMPO_RANGE) / 2 / 60 * RESOLUTION)
+    tracks = [get_tempo_track(rng, tick_count, tempo_changes)]
+    for instrument in range(instrument_count):
+        pitch_range = VOICE_RANGES[instrument] if instrument < len(VOICE_RANGES) else WIDE_RANGE
+        pitches, velocities, start_ticks, end_ticks = get_voice_notes(rng, tick_count, polyphony, pitch_range)
+        channel = common.NOTE_CHANNELS[instrument % len(common.NOTE_CHANNELS)]
+        tracks.append(common.get_note_track(52, channel, "Voice {}".format(instrument + 1), pitches, velocities,
+                                            start_ticks, end_ticks))
+    header = common.get_midi_chunk(b"MThd", struct.pack(">hhh", 1, len(tracks), RESOLUTION))
+    return header + b"".join(tracks)
+
+
+def generate_file(index: int, folder: str, config: Dict[str, any]) -> str:
+    # every file has its own generator, so the corpus does not depend on the number of jobs
+    rng = random.Random("{}:{}".format(config["seed"], index))
+    data = generate_piece(rng,
+                          rng.uniform(config["min_duration"], config["max_duration"]),
+                          rng.choice(config["polyphony"]),
+                          rng.choice(config["instruments"]),
+                          rng.randint(0, config["tempo_changes"]))
+    file = os.path.join(folder, "piece_{:05d}.mid".format(index))
+    with open(file, "wb") as f:
+        f.write(data)
+    return file
+
+
+def generate_corpus(folder: str, config: Dict[str, any], jobs: int = 1) -> bool:
+    info_file = os.path.join(folder, CORPUS_INFO_FILE)
+    if os.path.exists(info_file):
+        with open(info_file, "r", encoding="utf-8") as f:
+            if json.load(f) == config:
+                return False
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    common.map_files(partial(generate_file, folder=folder, config=config), list(range(config["files"])), jobs)
+    with open(info_file, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    return True
+
+
+def count_notes(file: str) -> Tuple[int, float]:
+    notes = common.load_midi_notes(file)
+    if notes is None:
+        return 0, 0.
+    return len(notes["pitches"]), float(notes["end_time"])
+
+
+def get_stage_input(paths: List[str], jobs: int = 1) -> Dict[str, any]:
+    files = [file for path in paths for file in common.get_stage_files(path, "mid")]
+    counts = common.map_files(count_notes, files, jobs)
+    return {
+        "files": len(files),
+        "notes": sum(count for count, _ in counts),
+        "bytes": sum(os.path.getsize(file) for file in files),
+        "duration": sum(duration for _, duration in counts)
+    }
+
+
+def run_stage_process(queue: multiprocessing.Queue, function, args: tuple, verbose: bool):
+    if not verbose:
+        # on the descriptor, so the workers of the stage are quiet too however they are started
+        sys.stdout.flush()
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    queue.put((result, seconds, get_peak_memory(), get_peak_memory(children=True)))
+
+
+def run_stage(name: str, function, args: tuple, verbose: bool = False) -> Tuple[any, Dict[str, any]]:
+    # a fresh process per stage, so the peak memory of one stage does not hide the ones after it
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    stage_process = context.Process(target=run_stage_process, args=(queue, function, args, verbose))
+    stage_process.start()
+    stage_process.join()
+    if stage_process.exitcode != 0:
+        raise click.ClickException("Stage {} failed with exit code {}.".format(name, stage_process.exitcode))
+    result, seconds, peak_memory, peak_worker_memory = queue.get()
+    return result, {"seconds": seconds, "peak_memory": peak_memory, "peak_worker_memory": peak_worker_memory}
+
+
+def get_stage_result(name: str, stage_input: Dict[str, any], runs: List[Dict[str, any]]) -> Dict[str, any]:
+    seconds = min(run["seconds"] for run in runs)
+    memory = [run["peak_memory"] for run in runs if run["peak_memory"] is not None]
+    worker_memory = [run["peak_worker_memory"] for run in runs if run["peak_worker_memory"] is not None]
+    return {
+        "name": name,
+        "seconds": seconds,
+        "runs": [run["seconds"] for run in runs],
+        "files_per_second": stage_input["files"] / seconds if seconds > 0 else None,
+        "notes_per_second": stage_input["notes"] / seconds if seconds > 0 else None,
+        "peak_memory": max(memory) if len(memory) > 0 else None,
+        "peak_worker_memory": max(worker_memory) if len(worker_memory) > 0 else None,
+        "input": stage_input
+    }
+
+
+def get_mode_stages(mode: str, input_dir: str, output_dir: str, options: Dict[str, any],
+                    cache: Cache) -> List[Tuple[str, any, tuple, List[str]]]:
+    # stages with their function, arguments and the inputs they read, later stages read the outputs of earlier ones
+    note_count = options["note_count"]
+    time_steps = options["time_steps"]
+    fast_reject = options["fast_reject"]
+    min_length = options["min_length"]
+    max_length = options["max_length"]
+    seed = options["seed"]
+    jobs = options["jobs"]
+    output_format = options["output_format"]
+    buffer_size = int(options["buffer_size"] * 1024 * 1024)
+    link_mode = options["link_mode"]
+    if mode == "fused":
+        return [("fused", convert.fuse_midis, (input_dir, output_dir, note_count, time_steps, fast_reject, min_length,
+                                               max_length, seed, False, jobs, cache, output_format, buffer_size),
+                 [input_dir])]
+    if mode == "windows":
+        return [("windows", convert.window_midis, (input_dir, output_dir, note_count, time_steps, fast_reject,
+                                                   min_length, max_length, seed, 0, jobs, cache, buffer_size),
+                 [input_dir])]
+
+    extension = common.MANIFEST_EXTENSION if link_mode == "manifest" else ""
+    filtered = os.path.join(output_dir, "filtered" + extension)
+    splitted = os.path.join(output_dir, "splitted")
+    sets = os.path.join(output_dir, "sets")
+    return [
+        ("filter", convert.filter_midis, (input_dir, output_dir, note_count, time_steps, fast_reject, jobs, cache,
+                                          link_mode), [input_dir]),
+        ("split", convert.split_midis, (filtered, output_dir, min_length, max_length, seed, jobs), [filtered]),
+        ("separate", convert.separate_midis, (splitted, output_dir, seed, link_mode), [splitted]),
+        ("transform", convert.transform_midis, (sets, output_dir, time_steps, note_count, False, jobs, cache,
+                                                output_format, buffer_size, link_mode),
+         [os.path.join(sets, name + extension) for name in ["train", "test", "valid"]])
+    ]
+
+
+def run_mode(mode: str, input_dir: str, output_dir: str, options: Dict[str, any], repeat: int = 1,
+             verbose: bool = False) -> List[Dict[str, any]]:
+    mode_folder = os.path.join(output_dir, mode)
+    suboutput = os.path.join(mode_folder, CORPUS_NAME)
+    cache = None
+    if options["cache_dir"] is not None:
+        cache = Cache(os.path.join(options["cache_dir"], mode))
+        # the first run fills the cache, the ones after it measure the cached stages
+        cache.clear()
+
+    stage_names = [stage[0] for stage in get_mode_stages(mode, input_dir, suboutput, options, cache)]
+    stage_runs = {name: [] for name in stage_names}
+    stage_inputs = {}
+    for _ in range(repeat):
+        if os.path.isdir(mode_folder):
+            shutil.rmtree(mode_folder)
+        os.makedirs(suboutput)
+        for name, function, args, inputs in get_mode_stages(mode, input_dir, suboutput, options, cache):
+            if name not in stage_inputs:
+                stage_inputs[name] = get_stage_input(inputs, options["jobs"])
+            _, run = run_stage(name, function, args, verbose)
+            stage_runs[name].append(run)
+            click.echo("{} {}: {:.2f}s".format(mode, name, run["seconds"]))
+    return [get_stage_result(name, stage_inputs[name], stage_runs[name]) for name in stage_names]
+
+
+def measure_startup(args: List[str], runs: int = STARTUP_RUNS) -> List[float]:
+    result = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, CLI_FILE] + args + ["--help"], stdout=subprocess.DEVNULL, check=True)
+        result.append(time.perf_counter() - start)
+    return result
+
+
+def run_startup(repeat: int = 1) -> List[Dict[str, any]]:
+    result = []
+    for command in [None] + list(cli.COMMANDS):
+        args = [] if command is None else [command]
+        runs = measure_startup(args, max(repeat, STARTUP_RUNS))
+        # the fastest run, the others pay for files not yet in the file system cache
+        seconds = min(runs)
+        with_target = command is None or command in STARTUP_TARGET_COMMANDS
+        result.append({
+            "name": " ".join(["cli"] + args),
+            "seconds": seconds,
+            "runs": runs,
+            "target": STARTUP_TARGET if with_target else None,
+            "within_target": seconds <= STARTUP_TARGET if with_target else None
+        })
+        click.echo("startup {}: {:.0f}ms".format(result[-1]["name"], seconds * 1000))
+    return result
+
+
+def get_environment() -> Dict[str, any]:
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def format_rate(value: float) -> str:
+    return "{:.1f}".format(value) if value is not None else "-"
+
+
+def print_results(results: Dict[str, any]):
+    for mode, stages in results["modes"].items():
+        for stage in stages:
+            if mode == "startup":
+                target = ""
+                if stage["target"] is not None:
+                    target = ", {} the target of {:.0f}ms".format("within" if stage["within_target"] else "over",
+                                                                  stage["target"] * 1000)
+                click.echo("startup {}: {:.0f}ms{}".format(stage["name"], stage["seconds"] * 1000, target))
+                continue
+            memory = format_size(stage["peak_memory"]) if stage["peak_memory"] is not None else "-"
+            click.echo("{} {}: {:.2f}s, {} files/s, {} notes/s, peak memory {}".format(
+                mode, stage["name"], stage["seconds"], format_rate(stage["files_per_second"]),
+                format_rate(stage["notes_per_second"]), memory))
+
+
+def print_comparison(results: Dict[str, any], previous: Dict[str, any]):
+    for mode, stages in results["modes"].items():
+        previous_stages = {stage["name"]: stage for stage in previous.get("modes", {}).get(mode, [])}
+        for stage in stages:
+            previous_stage = previous_stages.get(stage["name"])
+            if previous_stage is None:
+                continue
+            click.echo("{} {}: {:.2f}s -> {:.2f}s ({:.2f}x)".format(
+                mode, stage["name"], previous_stage["seconds"], stage["seconds"],
+                previous_stage["seconds"] / stage["seconds"] if stage["seconds"] > 0 else float("inf")))
+
+
+@click.command()
+@click.option("output_dir", "--output", "-o", type=click.Path(file_okay=False), required=True)
+@click.option("result_file", "--result", type=click.Path(dir_okay=False), default=None,
+              help="Results file, defaults to benchmark.json in the output folder.")
+@click.option("compare_file", "--compare", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Results of an earlier run to compare with.")
+@click.option("--mode", "modes", multiple=True, default=["disk", "fused"], type=click.Choice(MODES),
+              show_default=True)
+@click.option("--files", default=100, type=int, show_default=True)
+@click.option("--min_duration", default=30, type=float, show_default=True, help="Shortest piece in seconds.")
+@click.option("--max_duration", default=240, type=float, show_default=True, help="Longest piece in seconds.")
+@click.option("--polyphony", multiple=True, default=[1, 2], type=int, show_default=True,
+              help="Notes each instrument plays at once.")
+@click.option("--instruments", multiple=True, default=[1, 2, 4, 6], type=int, show_default=True)
+@click.option("--tempo_changes", default=4, type=int, show_default=True, help="Most tempo changes of a piece.")
+@click.option("--corpus_seed", default=0, type=int, show_default=True)
+@click.option("--note_count", "-count", default=4, type=int, show_default=True)
+@click.option("--time_steps", "-time", default=0.125, type=float, show_default=True)
+@click.option("--min_length", "-min", default=15, type=float, show_default=True)
+@click.option("--max_length", "-max", default=90, type=float, show_default=True)
+@click.option("--fast_reject", is_flag=True, default=False, show_default=True)
+@click.option("--seed", default=0, type=int, show_default=True)
+@click.option("--jobs", "-j", default=1, type=int, show_default=True)
+@click.option("--link_mode", default="copy", type=click.Choice(common.LINK_MODES), show_default=True)
+@click.option("cache_dir", "--cache_dir", type=click.Path(file_okay=False), default=None)
+@click.option("output_format", "--format", default="legacy", type=click.Choice(process.OUTPUT_FORMATS),
+              show_default=True)
+@click.option("--buffer_size", default=64, type=float, show_default=True)
+@click.option("--repeat", default=1, type=int, show_default=True, help="Runs of every stage, the fastest counts.")
+@click.option("--verbose", "-v", is_flag=True, default=False, show_default=True)
+def main(output_dir: str,
+         result_file: str = None,
+         compare_file: str = None,
+         modes: List[str] = ("disk", "fused"),
+         files: int = 100,
+         min_duration: float = 30,
+         max_duration: float = 240,
+         polyphony: List[int] = (1, 2),
+         instruments: List[int] = (1, 2, 4, 6),
+         tempo_changes: int = 4,
+         corpus_seed: int = 0,
+         note_count: int = 4,
+         time_steps: float = 0.125,
+         min_length: float = 15,
+         max_length: float = 90,
+         fast_reject: bool = False,
+         seed: int = 0,
+         jobs: int = 1,
+         link_mode: str = "copy",
+         cache_dir: str = None,
+         output_format: str = "legacy",
+         buffer_size: float = 64,
+         repeat: int = 1,
+         verbose: bool = False):
+    corpus_config = {
+        "version": BENCHMARK_VERSION,
+        "files": files,
+        "min_duration": min_duration,
+        "max_duration": max_duration,
+        "polyphony": list(polyphony),
+        "instruments": list(instruments),
+        "tempo_changes": tempo_changes,
+        "seed": corpus_seed
+    }
+    options = {
+        "note_count": note_count,
+        "time_steps": time_steps,
+        "min_length": min_length,
+        "max_length": max_length,
+        "fast_reject": fast_reject,
+        "seed": seed,
+        "jobs": jobs,
+        "link_mode": link_mode,
+        "cache_dir": cache_dir,
+        "output_format": output_format,
+        "buffer_size": buffer_size,
+        "repeat": repeat
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    if result_file is None:
+        result_file = os.path.join(output_dir, "benchmark.json")
+
+    corpus_dir = os.path.join(output_dir, "corpus", CORPUS_NAME)
+    corpus = {}
+    if any(mode != "startup" for mode in modes):
+        click.echo("Generating {} pieces into {}...".format(files, corpus_dir))
+        if not generate_corpus(corpus_dir, corpus_config, jobs):
+            click.echo("Corpus is up to date.")
+        corpus = get_stage_input([corpus_dir], jobs)
+        click.echo("Corpus: {} files, {} notes, {}".format(corpus["files"], corpus["notes"],
+                                                          format_size(corpus["bytes"])))
+
+    results = {
+        "version": BENCHMARK_VERSION,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": get_environment(),
+        "corpus": dict(corpus_config, **corpus),
+        "options": options,
+        "modes": {}
+    }
+    for mode in modes:
+        click.echo("Running {} mode...".format(mode))
+        if mode == "startup":
+            results["modes"][mode] = run_startup(repeat)
+        else:
+            results["modes"][mode] = run_mode(mode, corpus_dir, output_dir, options, repeat, verbose)
+
+    with open(result_file, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print_results(results)
+    if compare_file is not None:
+        with open(compare_file, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        click.echo("Compared with {}:".format(compare_file))
+        print_comparison(results, previous)
+    click.echo("Saved results to {}.".format(result_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Content addressed cache for parsed notes, analysis results and quantized grids
+Entries are keyed by the hash of the source file and the parameters they depend on,
+the least recently used entries are removed when the cache grows over its size limit
+"""
+
+import hashlib
+import os
+import shutil
+import time
+import zipfile
+from typing import List, Dict, Tuple
+
+import click
+import numpy as np
+
+from files import get_file_hash
+
+CACHE_VERSION = 1
+
+
+def get_cache_key(file_hash: str, **params) -> str:
+    text = "{}:{}:{}".format(CACHE_VERSION, file_hash,
+                             ",".join("{}={!r}".format(name, params[name]) for name in sorted(params)))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class Cache:
+    def __init__(self, folder: str, max_size: int = None):
+        self.folder = folder
+        self.max_size = max_size
+
+    def get_path(self, kind: str, key: str) -> str:
+        return os.path.join(self.folder, kind, key[:2], "{}.npz".format(key))
+
+    def get(self, kind: str, key: str) -> Dict[str, np.ndarray]:
+        path = self.get_path(kind, key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                result = {name: npz[name] for name in npz.files}
+            # the modification time marks the last use for the eviction
+            os.utime(path)
+        except (IOError, ValueError, zipfile.BadZipFile):
+            return None
+        return result
+
+    def put(self, kind: str, key: str, arrays: Dict[str, np.ndarray]):
+        path = self.get_path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write next to the entry and rename it, so parallel workers never read half written files
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def get_entries(self) -> List[Tuple[str, str, int, float]]:
+        result = []
+        if not os.path.isdir(self.folder):
+            return result
+        for kind in sorted(os.listdir(self.folder)):
+            for root, _, files in os.walk(os.path.join(self.folder, kind)):
+                for file in files:
+                    if not file.endswith(".npz"):
+                        continue
+                    path = os.path.join(root, file)
+                    stat = os.stat(path)
+                    result.append((kind, path, stat.st_size, stat.st_mtime))
+        return result
+
+    def prune(self, max_size: int = None) -> Tuple[int, int]:
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0, 0
+
+        entries = sorted(self.get_entries(), key=lambda entry: entry[3])
+        total_size = sum(entry[2] for entry in entries)
+        removed_count = 0
+        removed_size = 0
+        for _, path, size, _ in entries:
+            if total_size <= max_size:
+                break
+            os.remove(path)
+            total_size -= size
+            removed_count += 1
+            removed_size += size
+        return removed_count, removed_size
+
+    def clear(self):
+        if os.path.isdir(self.folder):
+            shutil.rmtree(self.folder)
+
+
+def format_size(size: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return "{:.1f}{}".format(size, unit)
+        size /= 1024
+    return "{:.1f}TB".format(size)
+
+
+@click.command()
+@click.option("cache_dir", "--cache_dir", "-d", type=click.Path(file_okay=False), required=True)
+@click.option("--max_size", "-max", default=None, type=float, help="Prune to this many MB.")
+@click.option("--clear", is_flag=True, default=False, show_default=True)
+def main(cache_dir: str,
+         max_size: float = None,
+         clear: bool = False):
+    cache = Cache(cache_dir)
+    if clear:
+        click.echo("Clearing {}...".format(cache_dir))
+        cache.clear()
+    if max_size is not None:
+        count, size = cache.prune(int(max_size * 1024 * 1024))
+        click.echo("Removed {} entries with {}.".format(count, format_size(size)))
+
+    entries = cache.get_entries()
+    kinds = sorted(set(entry[0] for entry in entries))
+    for kind in kinds:
+        kind_entries = [entry for entry in entries if entry[0] == kind]
+        click.echo("{}: {} entries, {}, last used {}".format(
+            kind, len(kind_entries), format_size(sum(entry[2] for entry in kind_entries)),
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(max(entry[3] for entry in kind_entries)))))
+    click.echo("Total: {} entries, {}".format(len(entries), format_size(sum(entry[2] for entry in entries))))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,14 @@ Analysis of MIDI files and filtering MIDI files according to note count
 tl;dr check if max 4 notes concurrently
 """
 
-from math import floor
-from typing import List, Dict
+from functools import partial
+from typing import List, Dict, Tuple
 import numpy as np
 
 from common import *
+from corpus_index import CorpusIndex
+from metrics import Metrics
+from satb_report import VOICE_THRESHOLD, save_report, get_accepted
 
 import click
 
@@ -15,147 +18,159 @@ from colorama import init, Fore, Style
 
 init()
 
-RANGE_SOPRAN = (60, 81)
-RANGE_ALT = (52, 74)
-RANGE_TENOR = (46, 69)
-RANGE_BASS = (36, 66)
-
-RANGE_VOICES = [
-    ("sopran", RANGE_SOPRAN),
-    ("alt", RANGE_ALT),
-    ("tenor", RANGE_TENOR),
-    ("bass", RANGE_BASS)
-]
-
-
-def get_multiple_number_greater_than(factor: float, target: float):
-    tmp = target / factor
-    tmp = floor(tmp)
-    result = tmp * factor
-    if result < target:
-        tmp += 1
-        result = tmp * factor
-    return result
 
+# check_satb ignores notes shorter than one step
+QUANTIZE_RULES = {"skip_short": True}
 
-def get_notes_from_instrument(instr: pretty_midi.Instrument, steps: float) -> Dict[float, List[pretty_midi.Note]]:
-    result: Dict[float, List[pretty_midi.Note]] = {}
-    note: pretty_midi.Note
-    for note in instr.notes:
-        if note.duration < steps:
-            continue
-        note_time = timespan_from_note(note)
-        time = get_multiple_number_greater_than(steps, note_time.start)
-        while note_time.contains(time):
-            if time not in result:
-                result[time] = [note]
-            else:
-                result[time].append(note)
-            time += steps
-    return result
 
+PITCH_COUNT = 128
+# one row per voice with ones for the pitches in its range, so the histograms give the notes in range at once
+VOICE_MASKS = np.array([[low <= pitch <= high for pitch in range(PITCH_COUNT)] for _, (low, high) in RANGE_VOICES],
+                       dtype=np.float64)
 
-def get_notes_from_midi(mid: pretty_midi.PrettyMIDI, steps: float) -> Dict[float, List[List[pretty_midi.Note]]]:
-    result: Dict[float, List[List[pretty_midi.Note]]] = {}
-    instr_count = len(mid.instruments)
 
-    for instr_index, instr in enumerate(mid.instruments):
-        extracted_notes = get_notes_from_instrument(instr, steps)
-        for time, notes in extracted_notes.items():
-            if time not in result:
-                result[time] = [[] for _ in range(instr_count)]
-            result[time][instr_index].extend(notes)
-    return result
+def get_pitch_histograms(instruments: np.ndarray, pitches: np.ndarray, lengths: np.ndarray,
+                         instrument_count: int) -> np.ndarray:
+    # how many steps every instrument plays every pitch, a note counts once for every step it sounds in
+    keys = instruments * PITCH_COUNT + pitches.astype(np.int64)
+    histograms = np.bincount(keys, weights=lengths, minlength=instrument_count * PITCH_COUNT)
+    return histograms.reshape((instrument_count, PITCH_COUNT))
 
 
-def get_pitch_ranges_from_instrument(notes: Dict[float, List[List[pretty_midi.Note]]], instr_index: int) -> Tuple[
-    int, int]:
-    pitch_min = 1000000
-    pitch_max = 0
-    note: pretty_midi.Note
-    for time, instr in notes.items():
-        for note in instr[instr_index]:
-            pitch_min = min(pitch_min, note.pitch)
-            pitch_max = max(pitch_max, note.pitch)
-    return pitch_min, pitch_max
+def get_grid_pitch_histograms(grid: NoteGrid) -> np.ndarray:
+    return get_pitch_histograms(grid.instruments, grid.pitches, grid.lengths, grid.instrument_count)
+
 
+def get_voice_likelihoods(histograms: np.ndarray) -> np.ndarray:
+    # the share of the notes of every instrument in the range of every voice
+    total = histograms.sum(axis=1, keepdims=True)
+    counts = histograms @ VOICE_MASKS.T
+    return np.divide(counts, total, out=np.zeros_like(counts), where=total > 0)
 
-def get_concurrent_note_count(notes: Dict[float, List[List[pretty_midi.Note]]]) -> int:
-    result_count = 0
 
-    for time, instruments in notes.items():
-        count = sum([len(instrument) for instrument in instruments])
-        result_count = max(result_count, count)
-    return result_count
+def get_voice_likelihoods_from_grid(grid: NoteGrid) -> np.ndarray:
+    return get_voice_likelihoods(get_grid_pitch_histograms(grid))
 
 
-def get_voice_likelihood(pitches: Tuple[int, int], voice: Tuple[int, int]) -> float:
-    count = 0
-    for pitch in range(pitches[0], pitches[1] + 1):
-        if voice[0] <= pitch <= voice[1]:
-            count += 1
-    return count / (voice[1] - voice[0])
+def get_pitch_ranges(histograms: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    played = histograms > 0
+    any_played = played.any(axis=1)
+    pitch_min = np.where(any_played, played.argmax(axis=1), 1000000)
+    pitch_max = np.where(any_played, PITCH_COUNT - 1 - played[:, ::-1].argmax(axis=1), 0)
+    return pitch_min, pitch_max
+
+
+def get_batch_voice_likelihoods(grids: List[NoteGrid]) -> List[np.ndarray]:
+    # the instruments of all files in one histogram, each file with its own instrument numbers
+    offsets = np.cumsum([0] + [grid.instrument_count for grid in grids])
+    if len(grids) == 0:
+        return []
+    histograms = get_pitch_histograms(
+        np.concatenate([grid.instruments + offset for grid, offset in zip(grids, offsets)]),
+        np.concatenate([grid.pitches for grid in grids]),
+        np.concatenate([grid.lengths for grid in grids]),
+        int(offsets[-1])
+    )
+    return np.split(get_voice_likelihoods(histograms), offsets[1:-1])
+
+
+def get_filtered_instruments(likelihoods: np.ndarray) -> np.ndarray:
+    return np.flatnonzero((likelihoods > VOICE_THRESHOLD).any(axis=1))
+
+
+def classify_grids(grids: List[NoteGrid], note_count: int) -> np.ndarray:
+    # the decisions of analyse_file for a batch of files
+    grids = [grid.with_rules(**QUANTIZE_RULES) for grid in grids]
+    result = np.zeros(len(grids), dtype=bool)
+    for i, (grid, likelihoods) in enumerate(zip(grids, get_batch_voice_likelihoods(grids))):
+        concurrent_count = grid.max_polyphony(note_count)
+        if concurrent_count > note_count:
+            filtered = get_filtered_instruments(likelihoods)
+            if len(filtered) > 0:
+                concurrent_count = grid.max_polyphony(note_count, filtered)
+        result[i] = concurrent_count <= note_count
+    return result
 
 
-def get_voice_likelihood_of_instrument(notes: Dict[float, List[List[pretty_midi.Note]]], instr_index: int) -> \
-        Dict[Tuple[str, Tuple[int, int]], float]:
-    total_note_count = 0
-    voice_notes_counts = {
-        RANGE_VOICES[0]: 0,
-        RANGE_VOICES[1]: 0,
-        RANGE_VOICES[2]: 0,
-        RANGE_VOICES[3]: 0
+def get_filtered_polyphony(grid: NoteGrid, likelihoods: np.ndarray) -> np.ndarray:
+    # entry k is the polyphony of the k + 1 instruments most likely to be a voice, every threshold filters
+    # one of these sets
+    order = np.argsort(-likelihoods.max(axis=1), kind="stable")
+    step_count = grid.step_count
+    if step_count == 0:
+        return np.zeros(grid.instrument_count, dtype=np.int64)
+    valid = grid.last >= grid.first
+    changes = np.zeros((grid.instrument_count, step_count + 1), dtype=np.int64)
+    np.add.at(changes, (grid.instruments[valid], grid.first[valid]), 1)
+    np.add.at(changes, (grid.instruments[valid], grid.last[valid] + 1), -1)
+    counts = np.cumsum(np.cumsum(changes, axis=1)[order], axis=0)
+    return counts.max(axis=1)
+
+
+def get_analysis(grid: NoteGrid) -> Dict[str, np.ndarray]:
+    grid = grid.with_rules(**QUANTIZE_RULES)
+    histograms = get_grid_pitch_histograms(grid)
+    likelihoods = get_voice_likelihoods(histograms)
+    pitch_min, pitch_max = get_pitch_ranges(histograms)
+    return {
+        "max_polyphony": grid.max_polyphony(),
+        "pitch_min": pitch_min,
+        "pitch_max": pitch_max,
+        "likelihoods": likelihoods,
+        "filtered_polyphony": get_filtered_polyphony(grid, likelihoods)
     }
-    for time, instruments in notes.items():
-        instr_notes = instruments[instr_index]
-        total_note_count += len(instr_notes)
 
-        for note in instr_notes:
-            for voice_tuple in RANGE_VOICES:
-                if is_in_range(note.pitch, voice_tuple[1][0], voice_tuple[1][1]):
-                    voice_notes_counts[voice_tuple] += 1
 
-    for voice_tuple in RANGE_VOICES:
-        voice_notes_counts[voice_tuple] = (
-                voice_notes_counts[voice_tuple] / total_note_count) if total_note_count > 0 else 0
-    return voice_notes_counts
+def get_file_analysis(file: str, time_steps: float = 0.125) -> Dict[str, np.ndarray]:
+    notes = load_midi_notes(file)
+    if notes is None:
+        return None
+    return get_analysis(get_note_grid_from_columns(notes, time_steps, **QUANTIZE_RULES))
 
 
-def get_voices(pitches: Tuple[int, int]) -> List[Tuple[str, float]]:
-    result = []
-    for voice in RANGE_VOICES:
-        result.append((voice[0], get_voice_likelihood(pitches, voice[1])))
-    return result
+def fast_analyse_file(file: Tuple[str, pretty_midi.PrettyMIDI], note_count: int, time_steps: float,
+                      grid: NoteGrid = None) -> bool:
+    if grid is None:
+        grid = get_note_grid(file[1], time_steps, **QUANTIZE_RULES)
+    else:
+        grid = grid.with_rules(**QUANTIZE_RULES)
 
+    concurrent_count = grid.max_polyphony(note_count)
+    if concurrent_count <= note_count:
+        # the filtered instruments can never have more concurrent notes than the whole piece
+        print_colored("{} has a maximum of {} concurrent notes.".format(file[0], concurrent_count), Fore.RED, False)
+        return True
 
-def extract_instrument(notes: Dict[float, List[List[pretty_midi.Note]]], instr_index: int,
-                       result: Dict[float, List[List[pretty_midi.Note]]] = None) \
-        -> Dict[float, List[List[pretty_midi.Note]]]:
-    if result is None:
-        result = {}
-    for time, instruments in notes.items():
-        if time not in result:
-            result[time] = [notes[time][instr_index]]
-        else:
-            result[time].append(notes[time][instr_index])
-    return result
+    filtered = get_filtered_instruments(get_voice_likelihoods_from_grid(grid))
+    if len(filtered) > 0:
+        concurrent_count = grid.max_polyphony(note_count, filtered)
+    print_colored("{} has more than {} concurrent notes in the recognized voices.".format(file[0], note_count),
+                  Fore.RED, concurrent_count > note_count)
+    return concurrent_count <= note_count
 
 
-def analyse_file(file: Tuple[str, pretty_midi.PrettyMIDI], note_count: int, time_steps: float) -> bool:
-    notes = get_notes_from_midi(file[1], time_steps)
-    concurrent_count = get_concurrent_note_count(notes)
+def analyse_file(file: Tuple[str, pretty_midi.PrettyMIDI], note_count: int, time_steps: float,
+                 fast_reject: bool = False,
+                 grid: NoteGrid = None) -> bool:
+    if fast_reject:
+        return fast_analyse_file(file, note_count, time_steps, grid)
+
+    if grid is None:
+        grid = get_note_grid(file[1], time_steps, **QUANTIZE_RULES)
+    else:
+        grid = grid.with_rules(**QUANTIZE_RULES)
+    concurrent_count = grid.max_polyphony()
     print_colored("{} has a maximum of {} concurrent notes.".format(file[0], concurrent_count), Fore.RED,
                   concurrent_count > note_count)
 
+    histograms = get_grid_pitch_histograms(grid)
+    likelihoods = get_voice_likelihoods(histograms)
+    pitch_min, pitch_max = get_pitch_ranges(histograms)
     instr: pretty_midi.Instrument
-    filtered_voice_count = 0
-    filtered_instr = None
-    for instr_index in range(len(file[1].instruments)):
-        instr = file[1].instruments[instr_index]
-        pitches = get_pitch_ranges_from_instrument(notes, instr_index)
-        likelihood = get_voice_likelihood_of_instrument(notes, instr_index)
-
-        voices = [(voice_tuple[0], val) for voice_tuple, val in likelihood.items()]
+    filtered_instr = []
+    for instr_index, instr in enumerate(file[1].instruments):
+        pitches = (pitch_min[instr_index], pitch_max[instr_index])
+        voices = [(voice_tuple[0], val) for voice_tuple, val in zip(RANGE_VOICES, likelihoods[instr_index])]
         print_colored("{}:{}({}) with {},{} has voice likelihood: {}".format(
             file[0], instr.name,
             instr.program,
@@ -165,7 +180,7 @@ def analyse_file(file: Tuple[str, pretty_midi.PrettyMIDI], note_count: int, time
                 for voice in
                 voices])
         ), Fore.BLUE)
-        filtered_voices = [voice[0] for voice in voices if voice[1] > 0.9]
+        filtered_voices = [voice[0] for voice in voices if voice[1] > VOICE_THRESHOLD]
         if len(filtered_voices) > 0:
             print_colored("{}:{}({}) with {},{} has the following possible voices: {}".format(
                 file[0], instr.name,
@@ -173,8 +188,7 @@ def analyse_file(file: Tuple[str, pretty_midi.PrettyMIDI], note_count: int, time
                 pitches[0], pitches[1],
                 ", ".join(filtered_voices)
             ), Fore.GREEN)
-            filtered_voice_count += 1
-            filtered_instr = extract_instrument(notes, instr_index, filtered_instr)
+            filtered_instr.append(instr_index)
         else:
             print_colored("{}:{}({}) with {},{} has none of the requested voices.".format(
                 file[0], instr.name,
@@ -183,10 +197,10 @@ def analyse_file(file: Tuple[str, pretty_midi.PrettyMIDI], note_count: int, time
                     1]
             ), Fore.LIGHTRED_EX)
 
-    print_colored("{} has a maximum of {} recognized voices.".format(file[0], filtered_voice_count),
-                  Fore.RED, filtered_voice_count > note_count)
-    if filtered_instr is not None:
-        concurrent_count = get_concurrent_note_count(filtered_instr)
+    print_colored("{} has a maximum of {} recognized voices.".format(file[0], len(filtered_instr)),
+                  Fore.RED, len(filtered_instr) > note_count)
+    if len(filtered_instr) > 0:
+        concurrent_count = grid.max_polyphony(None, filtered_instr)
         print_colored(
             "{} has a maximum of {} concurrent notes in the filtered instruments.".format(file[0], concurrent_count),
             Fore.RED, concurrent_count > note_count
@@ -195,28 +209,88 @@ def analyse_file(file: Tuple[str, pretty_midi.PrettyMIDI], note_count: int, time
     return concurrent_count <= note_count
 
 
+def check_file(file: str, output_dir: str,
+               note_count: int = 4,
+               time_steps: float = 0.125,
+               fast_reject: bool = False) -> bool:
+    midi = None
+    grid = None
+    if fast_reject:
+        # the fast analysis only needs the notes, pretty_midi objects are built for the accepted files
+        notes = load_midi_notes(file)
+        if notes is None:
+            return False
+        grid = get_note_grid_from_columns(notes, time_steps, **QUANTIZE_RULES)
+    else:
+        midi = load_midi(file)
+        if midi is None:
+            return False
+    click.echo("\n\nAnalysing {}...".format(file))
+    if not analyse_file((file, midi), note_count, time_steps, fast_reject, grid):
+        return False
+    name = get_file_name(file)
+    output = "{}_{}.mid".format(name, "analysed")
+    output = os.path.join(output_dir, output)
+    click.echo("Saving {}...".format(output))
+    if midi is None:
+        midi = pretty_midi.PrettyMIDI(file)
+    midi.write(output)
+    return True
+
+
 @click.command()
 @click.option("input_dir", "--input", "-i", type=click.Path(exists=True, file_okay=False), required=True)
-@click.option("output_dir", "--output", "-o", type=click.Path(exists=True, file_okay=False), required=True)
+@click.option("output_dir", "--output", "-o", type=click.Path(exists=True, file_okay=False), default=None,
+              help="Folder for the accepted files, not needed with --analysis.")
 @click.option("--note_count", "-count", default=4, type=int, show_default=True)
-@click.option("--time_steps", "-time", default=0.125, type=float, show_default=True)
+@click.option("--time_steps", "-time", default=0.125, type=float, show_default=True,
+              help="Step length in seconds. Notes are counted on an integer step grid, for lengths that are not exact "
+                   "in binary (like 0.1) this finds more concurrent notes than earlier "
+                   "versions, which split one step across several float keys.")
+@click.option("--fast_reject", is_flag=True, default=False, show_default=True)
+@click.option("analysis_file", "--analysis", type=click.Path(dir_okay=False), default=None,
+              help="Write the metrics of all files to this report instead of saving the accepted files, "
+                   "see the filter command.")
+@click.option("index_file", "--index", type=click.Path(dir_okay=False), default=None,
+              help="Corpus index file, created if missing.")
+@click.option("profile_dir", "--profile", type=click.Path(file_okay=False), default=None,
+              help="Folder for a pstats dump of the run.")
+@click.option("--profile_threshold", default=None, type=float,
+              help="Only keep the profiles of files taking longer than this many seconds.")
 def main(input_dir: str,
-         output_dir: str,
+         output_dir: str = None,
          note_count: int = 4,
-         time_steps: float = 0.125):
-    click.echo(
-        "Analysing files from {} to {} with {} notes in {} steps...".format(input_dir, output_dir, note_count,
-                                                                            time_steps))
-    midis = load_midis_with_files(input_dir)
-    for file, midi in midis:
-        click.echo("\n\nAnalysing {}...".format(file))
-        if analyse_file((file, midi), note_count, time_steps):
-            name = get_file_name(file)
-            output = "{}_{}.mid".format(name, "analysed")
-            output = os.path.join(output_dir, output)
-            click.echo("Saving {}...".format(output))
-            midi.write(output)
-
+         time_steps: float = 0.125,
+         fast_reject: bool = False,
+         analysis_file: str = None,
+         index_file: str = None,
+         profile_dir: str = None,
+         profile_threshold: float = None):
+    if output_dir is None and analysis_file is None:
+        raise click.BadParameter("is required without --analysis", param_hint="--output")
+    index = CorpusIndex(index_file) if index_file is not None else None
+    files = index.get_files(input_dir, "mid") if index is not None else get_files(input_dir, "mid")
+    if analysis_file is not None:
+        click.echo("Analysing files from {} into {} in {} steps...".format(input_dir, analysis_file, time_steps))
+        metrics = Metrics(True, True, profile_dir, profile_threshold)
+        with metrics.stage("analyse"):
+            analyses = map_files(partial(get_file_analysis, time_steps=time_steps), files, 1, metrics)
+        files = [file for file, analysis in zip(files, analyses) if analysis is not None]
+        analyses = [analysis for analysis in analyses if analysis is not None]
+        report = save_report(analysis_file, files, analyses, time_steps, [voice[0] for voice in RANGE_VOICES])
+        click.echo("{} of {} files have at most {} notes in the recognized voices.".format(
+            int(get_accepted(report, note_count).sum()), len(files), note_count))
+    else:
+        click.echo(
+            "Analysing files from {} to {} with {} notes in {} steps...".format(input_dir, output_dir, note_count,
+                                                                                time_steps))
+        metrics = Metrics(False, False, profile_dir, profile_threshold)
+        with metrics.stage("analyse"):
+            map_files(partial(check_file, output_dir=output_dir, note_count=note_count, time_steps=time_steps,
+                              fast_reject=fast_reject), files, 1, metrics)
+
+    if index is not None:
+        index.save()
     click.echo("Done.")
 
 
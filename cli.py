@@ -0,0 +1,48 @@
+"""
+One command line for all tools, python cli.py <command> [OPTIONS]
+The module of a command is only imported when it runs, so the help and the commands working on files alone
+start without numpy and pretty_midi
+"""
+
+import importlib
+from typing import List
+
+import click
+
+# the help of every command is listed here, so the help of the group does not import the modules
+COMMANDS = {
+    "convert_dir": ("convert_dir", "Convert a folder of MIDI files into training data."),
+    "check_satb": ("check_satb", "Keep the MIDI files with at most note_count voices."),
+    "filter": ("satb_report", "Filter the files of an analysis report of check_satb."),
+    "split_midi": ("split_midi", "Split MIDI files into parts of random length."),
+    "separate_midis": ("separate_midis", "Separate files into train, test and valid sets."),
+    "process_midi": ("process_midi", "Process the sets into a training file."),
+    "reduce_midi": ("reduce_midi", "Reduce MIDI files to their quantized voices."),
+    "split_windows": ("split_windows", "Split quantized pieces into windows."),
+    "corpus_index": ("corpus_index", "Update the index of a corpus."),
+    "cache": ("cache", "Show, prune or clear the cache."),
+    "benchmark": ("benchmark", "Benchmark the stages of convert_dir on a synthetic corpus.")
+}
+
+
+class LazyGroup(click.Group):
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return list(COMMANDS)
+
+    def get_command(self, ctx: click.Context, name: str) -> click.Command:
+        if name not in COMMANDS:
+            return None
+        return importlib.import_module(COMMANDS[name][0]).main
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter):
+        with formatter.section("Commands"):
+            formatter.write_dl([(name, COMMANDS[name][1]) for name in self.list_commands(ctx)])
+
+
+@click.group(cls=LazyGroup)
+def main():
+    """Tools for preparing MIDI files as training data."""
+
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,42 @@
 import os
+import struct
+from math import floor, ceil, log
 from numbers import Number
 from typing import List, Dict, Generator, Tuple, Iterable
 
 import click
+import numpy as np
 import pretty_midi
 from colorama import Style
 
+from files import *
 
-def get_files(dir: str, extension: str = None, recursive: bool = False) -> List[str]:
-    result = []
-    files = os.listdir(dir)
-    for file in files:
-        fullpath = os.path.join(dir, file)
-        if os.path.isfile(fullpath):
-            if extension is None or file.endswith("." + extension):
-                result.append(fullpath)
-        elif recursive and os.path.isdir(fullpath):
-            result.extend(get_files(fullpath, extension, recursive))
-    return result
+
+def load_midi(file: str) -> pretty_midi.PrettyMIDI:
+    try:
+        mid = pretty_midi.PrettyMIDI(file)
+    except IOError:
+        return None
+    return mid
 
 
-def load_midis_with_files(dir: str, recursive: bool = False) -> Iterable[Tuple[str, pretty_midi.PrettyMIDI]]:
-    files = get_files(dir, "mid", recursive)
+def load_midis_with_files(dir: str, recursive: bool = False,
+                          index=None) -> Iterable[Tuple[str, pretty_midi.PrettyMIDI]]:
+    # index is an optional corpus_index.CorpusIndex which lists unchanged directories without scanning them
+    if index is not None:
+        files = index.iterate_files(dir, "mid", recursive)
+    else:
+        files = scan_files(dir, "mid", recursive)
     for file in files:
-        try:
-            mid = pretty_midi.PrettyMIDI(file)
+        mid = load_midi(file)
+        if mid is not None:
             yield (file, mid)
-        except IOError:
-            continue
 
 
 def load_midis(dir: str) -> Iterable[pretty_midi.PrettyMIDI]:
     return (pretty_midi.PrettyMIDI(file) for file in get_files(dir, "mid"))
 
 
-def get_file_name(path: str) -> str:
-    fullname = os.path.basename(path)
-    ext_point = fullname.rfind(".")
-    if ext_point != -1:
-        return fullname[:ext_point]
-    return fullname
-
-
 class Timespan:
     def __init__(self, start: float, end: float):
         self.start = start
@@ -76,15 +71,575 @@ def timespan_from_note(note: pretty_midi.Note) -> Timespan:
     return Timespan(note.start, note.end)
 
 
-def is_in_range(value: Number, min: Number, max: Number) -> bool:
-    return min <= value <= max
+RANGE_SOPRAN = (60, 81)
+RANGE_ALT = (52, 74)
+RANGE_TENOR = (46, 69)
+RANGE_BASS = (36, 66)
+
+RANGE_VOICES = [
+    ("sopran", RANGE_SOPRAN),
+    ("alt", RANGE_ALT),
+    ("tenor", RANGE_TENOR),
+    ("bass", RANGE_BASS)
+]
+
+SILENCE = -1
+POLYPHONY_CHUNK_SIZE = 4096
+
+
+def get_multiple_number_greater_than(factor: float, target: float, legacy_onset: bool = False):
+    tmp = target / factor
+    tmp = floor(tmp)
+    result = tmp * factor
+    if result < target:
+        if legacy_onset:
+            # the process_midi rule, which moves off-grid onsets on by one second instead of one step
+            return result + 1
+        tmp += 1
+        result = tmp * factor
+    return result
+
+
+def get_notes_from_instrument(instr: pretty_midi.Instrument, steps: float,
+                              skip_short: bool = False,
+                              legacy_onset: bool = False) -> Dict[float, List[pretty_midi.Note]]:
+    result: Dict[float, List[pretty_midi.Note]] = {}
+    note: pretty_midi.Note
+    for note in instr.notes:
+        if skip_short and note.duration < steps:
+            continue
+        note_time = timespan_from_note(note)
+        time = get_multiple_number_greater_than(steps, note_time.start, legacy_onset)
+        while note_time.contains(time):
+            if time not in result:
+                result[time] = [note]
+            else:
+                result[time].append(note)
+            time += steps
+    return result
+
+
+def get_step_spans(starts: np.ndarray, ends: np.ndarray, steps: float,
+                   skip_short: bool = False,
+                   legacy_onset: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    first = np.floor(starts / steps)
+    off_grid = first * steps < starts
+    first[off_grid] += ceil(1 / steps) if legacy_onset else 1
+    last = np.floor(ends / steps)
+    if skip_short:
+        last[ends - starts < steps] = -1
+    return first.astype(np.int64), last.astype(np.int64)
+
+
+def get_max_polyphony(first: np.ndarray, last: np.ndarray, limit: int = None) -> int:
+    valid = last >= first
+    first, last = first[valid], last[valid]
+    if len(first) == 0:
+        return 0
+
+    times = np.concatenate([first, last + 1])
+    changes = np.concatenate([np.ones(len(first), dtype=np.int64), -np.ones(len(last), dtype=np.int64)])
+    # note offs before note ons at the same step, a note ending at step n does not overlap one starting at n + 1
+    changes = changes[np.lexsort((changes, times))]
+    if limit is None:
+        return int(np.cumsum(changes).max())
+
+    result = 0
+    count = 0
+    for offset in range(0, len(changes), POLYPHONY_CHUNK_SIZE):
+        counts = count + np.cumsum(changes[offset:offset + POLYPHONY_CHUNK_SIZE])
+        result = max(result, int(counts.max()))
+        if result > limit:
+            break
+        count = int(counts[-1])
+    return result
+
+
+def quantize_notes(pitches: np.ndarray, first: np.ndarray, last: np.ndarray, desired_note_count: int) -> np.ndarray:
+    valid = last >= first
+    pitches, first, last = pitches[valid], first[valid], last[valid]
+    if len(first) == 0:
+        return np.full((0, desired_note_count), SILENCE, dtype=np.int8)
+
+    lengths = last - first + 1
+    note_index = np.repeat(np.arange(len(first)), lengths)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    step = np.repeat(first, lengths) + np.arange(len(note_index)) - offsets
+
+    # stable sort keeps the instrument and note order of the legacy dict within one step
+    order = np.argsort(step, kind="stable")
+    step = step[order]
+    note_index = note_index[order]
+    rank = np.arange(len(step)) - np.searchsorted(step, step, side="left")
+    keep = rank < desired_note_count
+
+    result = np.full((step[-1] + 1, desired_note_count), SILENCE, dtype=np.int8)
+    result[step[keep], rank[keep]] = pitches[note_index[keep]]
+    return result
+
+
+class NoteGrid:
+    def __init__(self, instruments: np.ndarray, pitches: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                 instrument_count: int, steps: float,
+                 skip_short: bool = False,
+                 legacy_onset: bool = False):
+        self.instruments = instruments
+        self.pitches = pitches
+        self.starts = starts
+        self.ends = ends
+        self.instrument_count = instrument_count
+        self.steps = steps
+        self.skip_short = skip_short
+        self.legacy_onset = legacy_onset
+        self.first, self.last = get_step_spans(starts, ends, steps, skip_short, legacy_onset)
+        self._arrays: Dict[int, np.ndarray] = {}
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.maximum(self.last - self.first + 1, 0)
+
+    @property
+    def step_count(self) -> int:
+        return int(self.last.max()) + 1 if (self.last >= self.first).any() else 0
+
+    def with_rules(self, skip_short: bool = False, legacy_onset: bool = False) -> "NoteGrid":
+        if skip_short == self.skip_short and legacy_onset == self.legacy_onset:
+            return self
+        return NoteGrid(self.instruments, self.pitches, self.starts, self.ends, self.instrument_count, self.steps,
+                        skip_short, legacy_onset)
+
+    def get_columns(self) -> Dict[str, np.ndarray]:
+        return {
+            "instruments": self.instruments,
+            "pitches": self.pitches,
+            "starts": self.starts,
+            "ends": self.ends,
+            "instrument_count": np.array(self.instrument_count)
+        }
+
+    def max_polyphony(self, limit: int = None, instruments: Iterable[int] = None) -> int:
+        if instruments is None:
+            return get_max_polyphony(self.first, self.last, limit)
+        selected = np.isin(self.instruments, list(instruments))
+        return get_max_polyphony(self.first[selected], self.last[selected], limit)
+
+    def to_array(self, desired_note_count: int) -> np.ndarray:
+        if desired_note_count not in self._arrays:
+            self._arrays[desired_note_count] = quantize_notes(self.pitches, self.first, self.last,
+                                                              desired_note_count)
+        return self._arrays[desired_note_count]
+
+
+def get_note_grid(mid: pretty_midi.PrettyMIDI, steps: float,
+                  skip_short: bool = False,
+                  legacy_onset: bool = False) -> NoteGrid:
+    notes = [note for instr in mid.instruments for note in instr.notes]
+    instruments = np.array([instr_index
+                            for instr_index, instr in enumerate(mid.instruments)
+                            for _ in instr.notes], dtype=np.int64)
+    pitches = np.array([note.pitch for note in notes], dtype=np.int8)
+    starts = np.array([note.start for note in notes], dtype=np.float64)
+    ends = np.array([note.end for note in notes], dtype=np.float64)
+    return NoteGrid(instruments, pitches, starts, ends, len(mid.instruments), steps, skip_short, legacy_onset)
+
+
+def get_note_grid_from_columns(columns: Dict[str, np.ndarray], steps: float,
+                               skip_short: bool = False,
+                               legacy_onset: bool = False) -> NoteGrid:
+    return NoteGrid(columns["instruments"], columns["pitches"], columns["starts"], columns["ends"],
+                    int(columns["instrument_count"]), steps, skip_short, legacy_onset)
+
+
+MAX_TICK = 1e7
+# data bytes after the status byte, sysex and meta events carry their own length
+MESSAGE_SIZES = dict([(status, 2) for status in range(0x80, 0xC0)] +
+                     [(status, 1) for status in range(0xC0, 0xE0)] +
+                     [(status, 2) for status in range(0xE0, 0xF0)] +
+                     [(0xF1, 1), (0xF2, 2), (0xF3, 1), (0xF6, 0), (0xF8, 0), (0xFA, 0), (0xFB, 0), (0xFC, 0),
+                      (0xFE, 0)])
+META_SIZES = {0x20: 1, 0x51: 3, 0x54: 5, 0x58: 4, 0x59: 2}
+# mido drops the delta time of other meta events, pretty_midi never sees those ticks
+KNOWN_META_TYPES = {0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x09, 0x20, 0x21, 0x2F, 0x51, 0x54, 0x58, 0x59,
+                    0x7F}
+
+
+def read_variable_int(data: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
 
+class MidiNoteReader:
+    # decodes the note events of a file straight into columns, following pretty_midi for the instruments,
+    # the closing of overlapping notes, the tempo map and the end time
+    def __init__(self, data: bytes):
+        self.data = data
+        self.resolution = 0
+        self.instrument_map: Dict[Tuple[int, int, int], int] = {}
+        self.programs: List[int] = []
+        self.drums: List[bool] = []
+        self.names: List[str] = []
+        self.note_instruments: List[int] = []
+        self.note_pitches: List[int] = []
+        self.note_velocities: List[int] = []
+        self.note_starts: List[int] = []
+        self.note_ends: List[int] = []
+        # control changes without an instrument only count for the end time once the channel gets one
+        self.stragglers: Dict[Tuple[int, int], List[any]] = {}
+        self.event_ticks: List[int] = []
+        self.tempos: List[Tuple[int, int]] = []
+        self.max_tick = 0
 
-def get_and_create_folder_path(folder: str, name: str) -> str:
-    path = os.path.join(folder, name)
-    if not os.path.exists(path):
-        os.makedirs(path)
-    return path
+    def get_instrument(self, program: int, channel: int, track: int, name: str) -> int:
+        key = (program, channel, track)
+        if key not in self.instrument_map:
+            self.instrument_map[key] = len(self.programs)
+            self.programs.append(program)
+            self.drums.append(channel == 9)
+            self.names.append(name)
+            straggler = self.stragglers.get((channel, track))
+            if straggler is not None:
+                straggler[2] = True
+        return self.instrument_map[key]
+
+    def add_control_tick(self, program: int, channel: int, track: int, tick: int):
+        if (program, channel, track) in self.instrument_map:
+            self.event_ticks.append(tick)
+            return
+        straggler = self.stragglers.get((channel, track))
+        if straggler is None:
+            self.stragglers[(channel, track)] = [tick, tick, False]
+        else:
+            straggler[0] = min(straggler[0], tick)
+            straggler[1] = max(straggler[1], tick)
+
+    def read_meta(self, track: int, tick: int, meta_type: int, meta: bytes):
+        if len(meta) < META_SIZES.get(meta_type, 0) or (meta_type == 0x00 and len(meta) == 1):
+            raise IOError("meta event 0x{:02x} is too short".format(meta_type))
+        if meta_type == 0x54 and meta[0] >> 5 > 3:
+            raise IOError("unknown smpte frame rate")
+        if meta_type == 0x59 and (not -7 <= (meta[0] ^ 0x80) - 0x80 <= 7 or meta[1] > 1):
+            raise IOError("unknown key signature")
+        # mido checks the denominator with a floating point logarithm, which fails for some exponents
+        if meta_type == 0x58 and (log(2 ** meta[1], 2) != meta[1] or (track == 0 and meta[0] == 0)):
+            raise IOError("invalid time signature")
+        if track == 0 and meta_type == 0x51:
+            self.tempos.append((tick, (meta[0] << 16) | (meta[1] << 8) | meta[2]))
+        elif (track == 0 and meta_type in (0x58, 0x59)) or meta_type in (0x01, 0x05):
+            self.event_ticks.append(tick)
+
+    def read_track(self, track: int, pos: int, end: int):
+        data = self.data
+        tick = 0
+        last_status = None
+        track_name = ""
+        open_notes: Dict[Tuple[int, int], List[Tuple[int, int]]] = {}
+        programs = [0] * 16
+        if pos == end:
+            raise IOError("track {} has no events".format(track))
+        while pos != end:
+            if pos > end:
+                raise IOError("event crosses the end of track {}".format(track))
+            delta, pos = read_variable_int(data, pos)
+            status = data[pos]
+            pos += 1
+            running = status < 0x80
+            if running:
+                if last_status is None:
+                    raise IOError("running status without last status in track {}".format(track))
+                status = last_status
+                pos -= 1
+            elif status != 0xFF:
+                last_status = status
+
+            if status == 0xFF:
+                meta_type = data[pos]
+                length, pos = read_variable_int(data, pos + 1)
+                meta = data[pos:pos + length]
+                pos += length
+                if len(meta) < length:
+                    raise IOError("unexpected end of file")
+                if meta_type in KNOWN_META_TYPES:
+                    tick += delta
+                self.read_meta(track, tick, meta_type, meta)
+                if meta_type == 0x03:
+                    track_name = meta.decode("latin1")
+                continue
+            tick += delta
+            if status == 0xF0 or status == 0xF7:
+                # with running status the data byte was already taken as status byte
+                length, pos = read_variable_int(data, pos + 1 if running else pos)
+                sysex = data[pos:pos + length]
+                pos += length
+                if len(sysex) < length:
+                    raise IOError("unexpected end of file")
+                if sysex[:1] == b"\xf0":
+                    sysex = sysex[1:]
+                if sysex[-1:] == b"\xf7":
+                    sysex = sysex[:-1]
+                if len(sysex) > 0 and max(sysex) > 127:
+                    raise IOError("data byte must be in range 0..127")
+                continue
+
+            size = MESSAGE_SIZES.get(status)
+            if size is None:
+                raise IOError("undefined status byte 0x{:02x}".format(status))
+            if running and size == 0:
+                raise IOError("running status of 0x{:02x} without data bytes".format(status))
+            if size == 0:
+                continue
+            first = data[pos]
+            second = data[pos + 1] if size == 2 else 0
+            pos += size
+            if first > 127 or second > 127:
+                raise IOError("data byte must be in range 0..127")
+
+            kind = status & 0xF0
+            channel = status & 0x0F
+            if kind == 0x90 and second > 0:
+                key = (channel, first)
+                if key in open_notes:
+                    open_notes[key].append((tick, second))
+                else:
+                    open_notes[key] = [(tick, second)]
+            elif kind == 0x80 or kind == 0x90:
+                key = (channel, first)
+                if key not in open_notes:
+                    continue
+                notes = open_notes[key]
+                closing = [note for note in notes if note[0] != tick]
+                if len(closing) > 0:
+                    instrument = self.get_instrument(programs[channel], channel, track, track_name)
+                    for start, velocity in closing:
+                        self.note_instruments.append(instrument)
+                        self.note_pitches.append(first)
+                        self.note_velocities.append(velocity)
+                        self.note_starts.append(start)
+                        self.note_ends.append(tick)
+                if 0 < len(closing) < len(notes):
+                    # notes starting on this tick stay open
+                    open_notes[key] = [note for note in notes if note[0] == tick]
+                else:
+                    del open_notes[key]
+            elif kind == 0xC0:
+                programs[channel] = first
+            elif kind == 0xB0 or kind == 0xE0:
+                self.add_control_tick(programs[channel], channel, track, tick)
+        self.max_tick = max(self.max_tick, tick)
+
+    def read(self):
+        data = self.data
+        if data[:4] != b"MThd":
+            raise IOError("MThd not found. Probably not a MIDI file")
+        header_size = struct.unpack(">L", data[4:8])[0]
+        if header_size < 6 or len(data) < 14:
+            raise IOError("unexpected end of file")
+        _, track_count, self.resolution = struct.unpack(">hhh", data[8:14])
+        if track_count <= 0:
+            raise IOError("file has no tracks")
+        pos = 8 + header_size
+        for track in range(track_count):
+            if pos + 8 > len(data):
+                raise IOError("unexpected end of file")
+            name, size = struct.unpack(">4sL", data[pos:pos + 8])
+            if name != b"MTrk":
+                raise IOError("no MTrk header at start of track")
+            pos += 8
+            self.read_track(track, pos, pos + size)
+            pos += size
+        if self.max_tick + 1 > MAX_TICK:
+            raise IOError("MIDI file has a largest tick of {}, it is likely corrupt".format(self.max_tick + 1))
+        # a negative division is SMPTE timing, which pretty_midi does not read either
+        if self.resolution <= 0 or any(tempo == 0 for _, tempo in self.tempos):
+            raise IOError("MIDI file has no valid time division")
+
+    def get_tick_scales(self) -> Tuple[np.ndarray, np.ndarray]:
+        scales = [(0, 60.0 / (120.0 * self.resolution))]
+        for tick, tempo in self.tempos:
+            tick_scale = 60.0 / ((6e7 / tempo) * self.resolution)
+            if tick == 0:
+                scales = [(0, tick_scale)]
+            elif tick_scale != scales[-1][1]:
+                scales.append((tick, tick_scale))
+        return np.array([scale[0] for scale in scales], dtype=np.int64), \
+            np.array([scale[1] for scale in scales], dtype=np.float64)
+
+    def get_times(self, ticks: np.ndarray, scale_ticks: np.ndarray, tick_scales: np.ndarray) -> np.ndarray:
+        # the same operations as the tick to time table of pretty_midi, so the times are bit identical
+        offsets = np.zeros(len(scale_ticks))
+        for i in range(1, len(scale_ticks)):
+            offsets[i] = offsets[i - 1] + tick_scales[i - 1] * (scale_ticks[i] - scale_ticks[i - 1])
+        segments = np.searchsorted(scale_ticks, ticks, side="right") - 1
+        return offsets[segments] + tick_scales[segments] * (ticks - scale_ticks[segments])
+
+    def get_columns(self) -> Dict[str, np.ndarray]:
+        scale_ticks, tick_scales = self.get_tick_scales()
+        instruments = np.array(self.note_instruments, dtype=np.int64)
+        # pretty_midi lists the notes instrument by instrument
+        order = np.argsort(instruments, kind="stable")
+        starts = self.get_times(np.array(self.note_starts, dtype=np.int64)[order], scale_ticks, tick_scales)
+        ends = self.get_times(np.array(self.note_ends, dtype=np.int64)[order], scale_ticks, tick_scales)
+
+        end_ticks = list(self.event_ticks) + scale_ticks.tolist()
+        for straggler in self.stragglers.values():
+            if straggler[2]:
+                end_ticks.extend(straggler[:2])
+        end_times = self.get_times(np.array(end_ticks, dtype=np.int64), scale_ticks, tick_scales)
+        end_time = max(end_times.max(), ends.max()) if len(ends) > 0 else end_times.max()
+        return {
+            "instruments": instruments[order],
+            "pitches": np.array(self.note_pitches, dtype=np.int8)[order],
+            "velocities": np.array(self.note_velocities, dtype=np.int8)[order],
+            "starts": starts,
+            "ends": ends,
+            "instrument_count": np.array(len(self.programs)),
+            "programs": np.array(self.programs, dtype=np.int64),
+            "drums": np.array(self.drums, dtype=bool),
+            "names": np.array(self.names, dtype=str),
+            "end_time": np.array(end_time, dtype=np.float64)
+        }
+
+
+def read_midi_notes(file: str) -> Dict[str, np.ndarray]:
+    with open(file, "rb") as f:
+        reader = MidiNoteReader(f.read())
+    try:
+        reader.read()
+    except (IndexError, struct.error) as e:
+        raise IOError("unexpected end of file") from e
+    return reader.get_columns()
+
+
+def load_midi_notes(file: str) -> Dict[str, np.ndarray]:
+    try:
+        return read_midi_notes(file)
+    except IOError:
+        return None
+
+
+def count_midi_notes(file: str) -> int:
+    notes = load_midi_notes(file)
+    return len(notes["pitches"]) if notes is not None else 0
+
+
+def load_midi_notes_with_files(dir: str, recursive: bool = False,
+                               index=None) -> Iterable[Tuple[str, Dict[str, np.ndarray]]]:
+    if index is not None:
+        files = index.iterate_files(dir, "mid", recursive)
+    else:
+        files = scan_files(dir, "mid", recursive)
+    for file in files:
+        notes = load_midi_notes(file)
+        if notes is not None:
+            yield (file, notes)
+
+
+DEFAULT_RESOLUTION = 220
+DEFAULT_TEMPO = 120.0
+NOTE_CHANNELS = [channel for channel in range(16) if channel != 9]
+MAX_VARIABLE_INT = 1 << 28
+
+
+def encode_variable_ints(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # variable length integers as rows of four bytes and the mask of the bytes that are written
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) > 0 and (values.min() < 0 or values.max() >= MAX_VARIABLE_INT):
+        raise ValueError("variable int out of range")
+    result = np.stack([(values >> shift) & 0x7F for shift in (21, 14, 7, 0)], axis=1)
+    result[:, :3] |= 0x80
+    sizes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    return result.astype(np.uint8), np.arange(4)[np.newaxis, :] >= 4 - sizes[:, np.newaxis]
+
+
+def encode_variable_int(value: int) -> bytes:
+    result, mask = encode_variable_ints(np.array([value]))
+    return result[mask].tobytes()
+
+
+def get_ticks(times: np.ndarray, tick_scale: float) -> np.ndarray:
+    # time_to_tick of a PrettyMIDI without tempo changes, rounding half to even like round
+    return np.where(times > 0, np.rint(times / tick_scale), 0).astype(np.int64)
+
+
+def get_midi_chunk(name: bytes, data: bytes) -> bytes:
+    return name + struct.pack(">L", len(data)) + data
+
+
+def get_note_track(program: int, channel: int, name: str, pitches: np.ndarray, velocities: np.ndarray,
+                   start_ticks: np.ndarray, end_ticks: np.ndarray) -> bytes:
+    pitches = pitches.astype(np.int64)
+    velocities = velocities.astype(np.int64)
+    # notes off are notes on without velocity, at the same tick they sort before the notes on of their pitch
+    ticks = np.concatenate([start_ticks, end_ticks])
+    keys = np.concatenate([pitches * 256 + velocities, pitches * 256])
+    order = np.lexsort((keys, ticks))
+    ticks = ticks[order]
+
+    events = np.zeros((len(ticks), 7), dtype=np.uint8)
+    mask = np.ones((len(ticks), 7), dtype=bool)
+    events[:, :4], mask[:, :4] = encode_variable_ints(np.diff(ticks, prepend=0))
+    events[:, 4] = 0x90 | channel
+    # running status, only the first note on has its status byte
+    mask[1:, 4] = False
+    events[:, 5] = np.concatenate([pitches, pitches])[order]
+    events[:, 6] = np.concatenate([velocities, np.zeros_like(velocities)])[order]
+
+    data = b""
+    if name:
+        name_bytes = name.encode("latin1")
+        data += b"\x00\xff\x03" + encode_variable_int(len(name_bytes)) + name_bytes
+    data += bytes([0, 0xC0 | channel, program])
+    data += events[mask].tobytes()
+    data += b"\x01\xff\x2f\x00"
+    return get_midi_chunk(b"MTrk", data)
+
+
+def get_midi_bytes(notes: Dict[str, np.ndarray],
+                   resolution: int = DEFAULT_RESOLUTION,
+                   initial_tempo: float = DEFAULT_TEMPO) -> bytes:
+    # the same bytes PrettyMIDI(resolution=resolution, initial_tempo=initial_tempo).write produces for these notes
+    for name in ["pitches", "velocities", "programs"]:
+        values = np.asarray(notes[name])
+        if len(values) > 0 and (values.min() < 0 or values.max() > 127):
+            raise ValueError("{} have to be in range 0..127".format(name))
+    tick_scale = 60.0 / (initial_tempo * resolution)
+    tempo = int(6e7 / (60. / (tick_scale * resolution)))
+    timing = (b"\x00\xff\x51\x03" + struct.pack(">L", tempo)[1:] + b"\x00\xff\x58\x04\x04\x02\x18\x08" +
+              b"\x01\xff\x2f\x00")
+
+    instrument_count = len(notes["programs"])
+    instruments = np.asarray(notes["instruments"])
+    order = np.argsort(instruments, kind="stable")
+    bounds = np.searchsorted(instruments[order], np.arange(instrument_count + 1))
+    start_ticks = get_ticks(np.asarray(notes["starts"])[order], tick_scale)
+    end_ticks = get_ticks(np.asarray(notes["ends"])[order], tick_scale)
+    pitches = np.asarray(notes["pitches"])[order]
+    velocities = np.asarray(notes["velocities"])[order]
+
+    tracks = [get_midi_chunk(b"MTrk", timing)]
+    for instrument in range(instrument_count):
+        channel = 9 if notes["drums"][instrument] else NOTE_CHANNELS[instrument % len(NOTE_CHANNELS)]
+        part = slice(bounds[instrument], bounds[instrument + 1])
+        tracks.append(get_note_track(int(notes["programs"][instrument]), channel, str(notes["names"][instrument]),
+                                     pitches[part], velocities[part], start_ticks[part], end_ticks[part]))
+    header = get_midi_chunk(b"MThd", struct.pack(">hhh", 1, len(tracks), resolution))
+    return header + b"".join(tracks)
+
+
+def write_midi_notes(file: str, notes: Dict[str, np.ndarray],
+                     resolution: int = DEFAULT_RESOLUTION,
+                     initial_tempo: float = DEFAULT_TEMPO):
+    data = get_midi_bytes(notes, resolution, initial_tempo)
+    with open(file, "wb") as f:
+        f.write(data)
+
+
+def is_in_range(value: Number, min: Number, max: Number) -> bool:
+    return min <= value <= max
 
 
 def print_colored(text, color, colored=True):
@@ -7,95 +7,525 @@ verteilt diese gleichmaessig auf train/test/valid-Ordner und erstellt daraus dan
 
 
 import os
+import random
+import shutil
+import tempfile
+from functools import partial
+from typing import List, Dict, Tuple
 
 import click
+import numpy as np
+import pretty_midi
 
 import common
+from cache import Cache, get_cache_key, get_file_hash, format_size
+from corpus_index import CorpusIndex
+from metrics import Metrics
 import check_satb as check
 import split_midi as split
+import split_windows as win
 import separate_midis as sep
 import process_midi as process
 
+SPLIT_MODES = ["midi", "windows"]
+
+
+def get_analysis_key(file_hash: str, note_count: int, time_steps: float) -> str:
+    return get_cache_key(file_hash, note_count=note_count, time_steps=time_steps, **check.QUANTIZE_RULES)
+
+
+def get_cached_analysis(cache: Cache, file_hash: str, note_count: int, time_steps: float) -> bool:
+    if cache is None:
+        return None
+    analysis = cache.get("analysis", get_analysis_key(file_hash, note_count, time_steps))
+    return bool(analysis["accepted"]) if analysis is not None else None
+
+
+def put_cached_analysis(cache: Cache, file_hash: str, note_count: int, time_steps: float, accepted: bool):
+    if cache is not None:
+        cache.put("analysis", get_analysis_key(file_hash, note_count, time_steps), {"accepted": np.array(accepted)})
+
+
+def get_input_files(input_dir: str, index: CorpusIndex = None, cache: Cache = None,
+                    jobs: int = 1) -> List[Tuple[str, str]]:
+    if index is None:
+        return [(file, None) for file in common.get_files(input_dir, "mid")]
+    if cache is not None:
+        # the hashes are cache keys, a file overwritten in place does not change the mtime of its directory
+        index.verify = True
+    files = index.get_files(input_dir, "mid")
+    # the hashes of unchanged files come from the index, so cached files are not read again
+    hashes = index.get_hashes(files, jobs) if cache is not None else [None] * len(files)
+    index.save()
+    return list(zip(files, hashes))
+
+
+def call_with_hash(item: Tuple[str, str], function):
+    file, file_hash = item
+    return function(file, file_hash=file_hash)
+
+
+def filter_file(file: str, output_dir: str,
+                note_count: int = 4,
+                time_steps: float = 0.125,
+                fast_reject: bool = False,
+                cache: Cache = None,
+                link_mode: str = "copy",
+                file_hash: str = None) -> bool:
+    if file_hash is None and cache is not None:
+        file_hash = get_file_hash(file)
+    accepted = get_cached_analysis(cache, file_hash, note_count, time_steps)
+    if accepted is False:
+        return False
+
+    midi = None
+    if accepted is None:
+        midi = common.load_midi(file)
+        if midi is None:
+            return False
+        click.echo("\n\nAnalysing {}...".format(file))
+        accepted = check.analyse_file((file, midi), note_count, time_steps, fast_reject)
+        put_cached_analysis(cache, file_hash, note_count, time_steps, accepted)
+    if not accepted:
+        return False
+    if link_mode == "manifest":
+        return True
+
+    name = common.get_file_name(file)
+    output = "{}.mid".format(name)
+    output = os.path.join(output_dir, output)
+    if link_mode != "copy":
+        # the accepted files are unchanged, so a link to the original is enough
+        common.link_file(file, output, link_mode)
+        return True
+    if midi is None:
+        midi = common.load_midi(file)
+        if midi is None:
+            return False
+    click.echo("Saving {}...".format(output))
+    midi.write(output)
+    return True
+
 
 def filter_midis(input_dir: str, output_dir: str,
                  note_count: int = 4,
-                 time_steps: float = 0.125) -> str:
-    suboutput = common.get_and_create_folder_path(output_dir, "filtered")
+                 time_steps: float = 0.125,
+                 fast_reject: bool = False,
+                 jobs: int = 1,
+                 cache: Cache = None,
+                 link_mode: str = "copy",
+                 index: CorpusIndex = None,
+                 metrics: Metrics = None) -> str:
+    if link_mode == "manifest":
+        suboutput = os.path.join(output_dir, "filtered" + common.MANIFEST_EXTENSION)
+    else:
+        suboutput = common.get_and_create_folder_path(output_dir, "filtered")
     click.echo(
         "Filtering files from {} to {} with {} notes in {} steps...".format(input_dir, suboutput, note_count,
                                                                             time_steps))
-    midis = common.load_midis_with_files(input_dir)
-    for file, midi in midis:
-        click.echo("\n\nAnalysing {}...".format(file))
-        if check.analyse_file((file, midi), note_count, time_steps):
-            name = common.get_file_name(file)
-            output = "{}.mid".format(name)
-            output = os.path.join(suboutput, output)
-            click.echo("Saving {}...".format(output))
-            midi.write(output)
-
+    files = get_input_files(input_dir, index, cache, jobs)
+    function = partial(filter_file, output_dir=suboutput, note_count=note_count, time_steps=time_steps,
+                       fast_reject=fast_reject, cache=cache, link_mode=link_mode)
+    accepted = common.map_files(partial(call_with_hash, function=function), files, jobs, metrics)
+    if link_mode == "manifest":
+        common.write_manifest([file for (file, _), file_accepted in zip(files, accepted) if file_accepted],
+                              suboutput)
     return suboutput
 
 
 def split_midis(input_dir: str, output_dir: str,
                 min_length: float = 15,
-                max_length: float = 90) -> str:
+                max_length: float = 90,
+                seed: int = None,
+                jobs: int = 1,
+                metrics: Metrics = None) -> str:
     suboutput = common.get_and_create_folder_path(output_dir, "splitted")
     click.echo(
         "Splitting files from {} to {} with min: {}, max: {}...".format(input_dir, suboutput,
                                                                         min_length, max_length))
-    split.split_all_midis_from_dir(input_dir, suboutput, min_length, max_length)
+    split.split_all_midis_from_dir(input_dir, suboutput, min_length, max_length, seed, jobs, metrics)
     return suboutput
 
 
-def separate_midis(input_dir: str, output_dir: str) -> str:
+def separate_midis(input_dir: str, output_dir: str, seed: int = None, link_mode: str = "copy",
+                   metrics: Metrics = None) -> str:
     suboutput = common.get_and_create_folder_path(output_dir, "sets")
     click.echo(
         "Separating files from {} into {}...".format(input_dir, suboutput))
-    sep.copy_sets(sep.get_sets(input_dir), suboutput)
+    sep.copy_sets(sep.get_sets(input_dir, seed), suboutput, link_mode, metrics)
     return suboutput
 
 
 def transform_midis(input_dir: str, output_dir: str,
                     steps: float,
-                    desired_note_count: int):
-    train_dir = os.path.join(input_dir, "train")
-    test_dir = os.path.join(input_dir, "test")
-    valid_dir = os.path.join(input_dir, "valid")
+                    desired_note_count: int,
+                    legacy: bool = False,
+                    jobs: int = 1,
+                    cache: Cache = None,
+                    output_format: str = "legacy",
+                    buffer_size: int = process.DEFAULT_BUFFER_SIZE,
+                    link_mode: str = "copy",
+                    metrics: Metrics = None):
+    extension = common.MANIFEST_EXTENSION if link_mode == "manifest" else ""
+    train_dir = os.path.join(input_dir, "train" + extension)
+    test_dir = os.path.join(input_dir, "test" + extension)
+    valid_dir = os.path.join(input_dir, "valid" + extension)
 
     click.echo("Transforming files with steps={} and note_count={}...".format(steps, desired_note_count))
+    filename = os.path.join(output_dir, os.path.basename(output_dir))
+    if output_format != "legacy":
+        process.write_ragged_trainingsdata(train_dir, test_dir, valid_dir, steps, desired_note_count, filename,
+                                           output_format, legacy, jobs, cache, buffer_size, metrics)
+        return
+
     notes = process.build_trainingsdata(
         train_dir,
         test_dir,
         valid_dir,
         steps,
-        desired_note_count
+        desired_note_count,
+        legacy,
+        jobs,
+        cache,
+        metrics
     )
     click.echo("Saving data...")
-    filename = os.path.basename(output_dir)
-    process.save_trainingsdata(notes, os.path.join(output_dir, filename))
+    process.save_trainingsdata(notes, filename)
+
+
+def get_cached_note_grid(file: str, file_hash: str, time_steps: float,
+                         cache: Cache = None) -> Tuple[common.NoteGrid, float]:
+    notes_key = get_cache_key(file_hash) if cache is not None else None
+    columns = cache.get("notes", notes_key) if cache is not None else None
+    if columns is not None:
+        grid = common.get_note_grid_from_columns(columns, time_steps, **check.QUANTIZE_RULES)
+        return grid, float(columns["end_time"])
+
+    columns = common.load_midi_notes(file)
+    if columns is None:
+        return None, 0
+    grid = common.get_note_grid_from_columns(columns, time_steps, **check.QUANTIZE_RULES)
+    end_time = float(columns["end_time"])
+    if cache is not None:
+        cache.put("notes", notes_key, dict(grid.get_columns(), end_time=columns["end_time"]))
+    return grid, end_time
+
+
+def get_accepted_note_grid(file: str, file_hash: str,
+                           note_count: int = 4,
+                           time_steps: float = 0.125,
+                           fast_reject: bool = False,
+                           cache: Cache = None) -> Tuple[pretty_midi.PrettyMIDI, common.NoteGrid, float]:
+    accepted = get_cached_analysis(cache, file_hash, note_count, time_steps)
+    if accepted is False:
+        return None, None, 0
+
+    grid, end_time = get_cached_note_grid(file, file_hash, time_steps, cache)
+    if grid is None:
+        return None, None, 0
+    midi = None
+    if accepted is None:
+        click.echo("\n\nAnalysing {}...".format(file))
+        if not fast_reject:
+            # the full report needs the instrument names
+            midi = common.load_midi(file)
+        accepted = check.analyse_file((file, midi), note_count, time_steps, fast_reject, grid)
+        put_cached_analysis(cache, file_hash, note_count, time_steps, accepted)
+    if not accepted:
+        return None, None, 0
+    return midi, grid, end_time
+
+
+def fuse_file(file: str, output_dir: str,
+              note_count: int = 4,
+              time_steps: float = 0.125,
+              fast_reject: bool = False,
+              min_length: float = 15,
+              max_length: float = 90,
+              seed: int = 0,
+              write_intermediate: bool = False,
+              cache: Cache = None,
+              file_hash: str = None) -> List[Tuple[str, np.ndarray]]:
+    if file_hash is None and cache is not None:
+        file_hash = get_file_hash(file)
+    midi, grid, end_time = get_accepted_note_grid(file, file_hash, note_count, time_steps, fast_reject, cache)
+    if grid is None:
+        return []
+
+    name = common.get_file_name(file)
+    if write_intermediate:
+        if midi is None:
+            midi = common.load_midi(file)
+        midi.write(os.path.join(output_dir, "filtered", "{}.mid".format(name)))
+
+    result = []
+    tick_scale = split.get_part_tick_scale()
+    part_times = split.get_part_times(end_time, min_length, max_length,
+                                      split.get_file_rng("{}.mid".format(name), seed))
+    for i, (part_start, part_end) in enumerate(part_times):
+        part_name = "{}_{}.mid".format(name, i)
+        if write_intermediate:
+            split.create_sub_midi(midi, part_start, part_end).write(os.path.join(output_dir, "splitted", part_name))
+
+        part_key = None
+        part_notes = None
+        if cache is not None:
+            part_key = get_cache_key(file_hash, start_time=part_start, end_time=part_end, time_steps=time_steps,
+                                     note_count=note_count, **process.QUANTIZE_RULES)
+            part_notes = cache.get("grid", part_key)
+        if part_notes is None:
+            part_grid = split.create_sub_grid(grid, part_start, part_end, tick_scale)
+            part_notes = {"notes": process.get_note_array_from_midi(None, time_steps, note_count, part_grid)}
+            if cache is not None:
+                cache.put("grid", part_key, part_notes)
+        result.append((part_name, part_notes["notes"]))
+    return result
+
+
+def fuse_midis(input_dir: str, output_dir: str,
+               note_count: int = 4,
+               time_steps: float = 0.125,
+               fast_reject: bool = False,
+               min_length: float = 15,
+               max_length: float = 90,
+               seed: int = None,
+               write_intermediate: bool = False,
+               jobs: int = 1,
+               cache: Cache = None,
+               output_format: str = "legacy",
+               buffer_size: int = process.DEFAULT_BUFFER_SIZE,
+               index: CorpusIndex = None,
+               metrics: Metrics = None):
+    click.echo("Converting files from {} in memory...".format(input_dir))
+    if write_intermediate:
+        for folder in ["filtered", "splitted"]:
+            common.get_and_create_folder_path(output_dir, folder)
+
+    files = get_input_files(input_dir, index, cache, jobs)
+    split_seed = random.getrandbits(32) if seed is None else seed
+    function = partial(fuse_file, output_dir=output_dir, note_count=note_count, time_steps=time_steps,
+                       fast_reject=fast_reject, min_length=min_length, max_length=max_length, seed=split_seed,
+                       write_intermediate=write_intermediate, cache=cache)
+    function = partial(call_with_hash, function=function)
+
+    # the sets are only known once every part is named, until then the parts wait in a spool on disk
+    spool_folder = tempfile.mkdtemp(dir=output_dir)
+    spool_notes = None
+    try:
+        part_indices: Dict[str, int] = {}
+        with process.RaggedNotesWriter(spool_folder, note_count, ["parts"], buffer_size) as spool:
+            for file_parts in common.iterate_files(function, files, jobs, metrics=metrics):
+                for part_name, part_notes in file_parts:
+                    part_indices[part_name] = len(part_indices)
+                    spool.append("parts", part_notes)
+        spool_notes = process.open_ragged_notes(spool_folder, names=["parts"])["parts"]
+
+        click.echo("Separating {} parts...".format(len(part_indices)))
+        sets = sep.split_sets(sorted(part_indices), seed)
+        if write_intermediate:
+            splitted_folder = os.path.join(output_dir, "splitted")
+            sep.copy_sets([[os.path.join(splitted_folder, part) for part in part_set] for part_set in sets],
+                          common.get_and_create_folder_path(output_dir, "sets"))
+
+        filename = os.path.join(output_dir, os.path.basename(output_dir))
+        if output_format != "legacy":
+            with process.RaggedTrainingsdataWriter(filename, note_count, output_format, buffer_size) as writer:
+                for name, part_set in zip(["train", "test", "valid"], sets):
+                    for part in part_set:
+                        writer.append(name, spool_notes[part_indices[part]])
+        else:
+            notes = process.build_training_dict(*[[process.note_array_to_notelists(
+                spool_notes[part_indices[part]]) for part in part_set] for part_set in sets])
+            click.echo("Saving data...")
+            process.save_trainingsdata(notes, filename)
+    finally:
+        # the memory mapped parts have to be released before their folder is removed
+        spool_notes = None
+        shutil.rmtree(spool_folder, ignore_errors=True)
+
+
+def quantize_file(file: str,
+                  note_count: int = 4,
+                  time_steps: float = 0.125,
+                  fast_reject: bool = False,
+                  cache: Cache = None,
+                  file_hash: str = None) -> Tuple[str, np.ndarray]:
+    if file_hash is None and cache is not None:
+        file_hash = get_file_hash(file)
+    _, grid, _ = get_accepted_note_grid(file, file_hash, note_count, time_steps, fast_reject, cache)
+    if grid is None:
+        return None
+
+    piece_key = None
+    piece_notes = None
+    if cache is not None:
+        piece_key = get_cache_key(file_hash, time_steps=time_steps, note_count=note_count, **process.QUANTIZE_RULES)
+        piece_notes = cache.get("grid", piece_key)
+    if piece_notes is None:
+        piece_notes = {"notes": process.get_note_array_from_midi(None, time_steps, note_count, grid)}
+        if cache is not None:
+            cache.put("grid", piece_key, piece_notes)
+    return common.get_file_name(file), piece_notes["notes"]
+
+
+def window_midis(input_dir: str, output_dir: str,
+                 note_count: int = 4,
+                 time_steps: float = 0.125,
+                 fast_reject: bool = False,
+                 min_length: float = 15,
+                 max_length: float = 90,
+                 seed: int = None,
+                 overlap: float = 0,
+                 jobs: int = 1,
+                 cache: Cache = None,
+                 buffer_size: int = process.DEFAULT_BUFFER_SIZE,
+                 index: CorpusIndex = None,
+                 metrics: Metrics = None) -> str:
+    click.echo("Quantizing whole pieces from {}...".format(input_dir))
+    folder = os.path.join(output_dir, os.path.basename(output_dir) + process.WINDOWS_EXTENSION)
+    files = get_input_files(input_dir, index, cache, jobs)
+    function = partial(quantize_file, note_count=note_count, time_steps=time_steps, fast_reject=fast_reject,
+                       cache=cache)
+    function = partial(call_with_hash, function=function)
+
+    names = []
+    with process.RaggedNotesWriter(folder, note_count, ["pieces"], buffer_size) as writer:
+        for result in common.iterate_files(function, files, jobs, metrics=metrics):
+            if result is None:
+                continue
+            names.append(result[0])
+            writer.append("pieces", result[1])
+    win.save_pieces_info(folder, names, time_steps)
+
+    click.echo("Splitting {} pieces into windows...".format(len(names)))
+    win.split_windows(folder, min_length, max_length, seed, overlap)
+    return folder
 
 
 @click.command()
 @click.option("input_dir", "--input", "-i", type=click.Path(exists=True, file_okay=False), required=True, prompt=True)
 @click.option("output_dir", "--output", "-o", type=click.Path(exists=True, file_okay=False), required=True)
 @click.option("--note_count", "-count", default=4, type=int, show_default=True)
-@click.option("--time_steps", "-time", default=0.125, type=float, show_default=True)
+@click.option("--time_steps", "-time", default=0.125, type=float, show_default=True,
+              help="Step length in seconds. Notes are counted on an integer step grid, for lengths that are not exact "
+                   "in binary (like 0.1) this finds more concurrent notes than earlier "
+                   "versions, which split one step across several float keys.")
 @click.option("--min_length", "-min", default=15, type=float, show_default=True)
 @click.option("--max_length", "-max", default=90, type=float, show_default=True)
+@click.option("--legacy_quantization", is_flag=True, default=False, show_default=True)
+@click.option("--fast_reject", is_flag=True, default=False, show_default=True)
+@click.option("--seed", default=None, type=int)
+@click.option("--jobs", "-j", default=1, type=int, show_default=True)
+@click.option("--fused", is_flag=True, default=False, show_default=True)
+@click.option("--write_intermediate", is_flag=True, default=False, show_default=True)
+@click.option("--split_mode", default="midi", type=click.Choice(SPLIT_MODES), show_default=True,
+              help="Write MIDI parts or only a window index over the quantized pieces.")
+@click.option("--link_mode", default=None, type=click.Choice(common.LINK_MODES),
+              help="Copy, link or only list the files of the filter and separation stages.  [default: copy]")
+@click.option("--overlap", default=0, type=float, show_default=True, help="Seconds shared by following windows.")
+@click.option("cache_dir", "--cache_dir", type=click.Path(file_okay=False), default=None)
+@click.option("--cache_size", default=4096, type=float, show_default=True, help="Cache size limit in MB.")
+@click.option("index_file", "--index", type=click.Path(dir_okay=False), default=None,
+              help="Corpus index file of the input, created if missing.")
+@click.option("output_format", "--format", default=None, type=click.Choice(process.OUTPUT_FORMATS),
+              help="[default: legacy]")
+@click.option("--buffer_size", default=64, type=float, show_default=True,
+              help="Memory for pieces waiting to be written in MB, ragged formats only.")
+@click.option("report_file", "--report", type=click.Path(dir_okay=False), default=None,
+              help="JSON report with the metrics of every stage and file.")
+@click.option("--verbose", "-v", is_flag=True, default=False, show_default=True,
+              help="Print the messages of every file instead of the progress.")
+@click.option("profile_dir", "--profile", type=click.Path(file_okay=False), default=None,
+              help="Folder for a pstats dump of every stage.")
+@click.option("--profile_threshold", default=None, type=float,
+              help="Only keep the profiles of files taking longer than this many seconds.")
 def main(input_dir: str,
          output_dir: str,
          note_count: int = 4,
          time_steps: float = 0.125,
          min_length: float = 15,
-         max_length: float = 90):
+         max_length: float = 90,
+         legacy_quantization: bool = False,
+         fast_reject: bool = False,
+         seed: int = None,
+         jobs: int = 1,
+         fused: bool = False,
+         write_intermediate: bool = False,
+         split_mode: str = "midi",
+         link_mode: str = None,
+         overlap: float = 0,
+         cache_dir: str = None,
+         cache_size: float = 4096,
+         index_file: str = None,
+         output_format: str = None,
+         buffer_size: float = 64,
+         report_file: str = None,
+         verbose: bool = False,
+         profile_dir: str = None,
+         profile_threshold: float = None):
+    if split_mode == "windows":
+        if overlap >= min_length:
+            raise click.BadParameter("has to be shorter than --min_length", param_hint="--overlap")
+        if legacy_quantization:
+            raise click.UsageError("--legacy_quantization needs the MIDI files of the parts, "
+                                   "use it with --split_mode midi.")
+        # --format and --link_mode default to None, so given values can be told apart from the defaults
+        conflicts = [option for option, given in [("--fused", fused), ("--write_intermediate", write_intermediate),
+                                                  ("--format", output_format is not None),
+                                                  ("--link_mode", link_mode is not None)] if given]
+        if len(conflicts) > 0:
+            raise click.UsageError("{} can not be used with --split_mode windows, which always writes a ragged "
+                                   "folder with a window index.".format(", ".join(conflicts)))
+    if link_mode is None:
+        link_mode = "copy"
+    if output_format is None:
+        output_format = "legacy"
+
     suboutput = common.get_and_create_folder_path(output_dir, os.path.basename(input_dir))
     click.echo(f"Converting {input_dir} with {note_count} notes, {time_steps}s steps and piece lengths "
                f"of {min_length} to {max_length} and outputting into {suboutput}...")
-    filtered_folder = filter_midis(input_dir, suboutput, note_count, time_steps)
-    splitted_folder = split_midis(filtered_folder, suboutput, min_length, max_length)
-    set_folder = separate_midis(splitted_folder, suboutput)
-    transform_midis(set_folder, suboutput, time_steps, note_count)
+    cache = Cache(cache_dir, int(cache_size * 1024 * 1024)) if cache_dir is not None else None
+    index = CorpusIndex(index_file) if index_file is not None else None
+    # only the report shows the notes, counting them reads every file once more
+    metrics = Metrics(not verbose, not verbose, profile_dir, profile_threshold,
+                      common.count_midi_notes if report_file is not None else None)
+    if split_mode == "windows":
+        with metrics.stage("windows"):
+            window_midis(input_dir, suboutput, note_count, time_steps, fast_reject, min_length, max_length, seed,
+                         overlap, jobs, cache, int(buffer_size * 1024 * 1024), index, metrics)
+    elif fused:
+        if legacy_quantization:
+            raise click.UsageError("--legacy_quantization needs the MIDI files of the parts, use it without --fused.")
+        with metrics.stage("fused"):
+            fuse_midis(input_dir, suboutput, note_count, time_steps, fast_reject, min_length, max_length, seed,
+                       write_intermediate, jobs, cache, output_format, int(buffer_size * 1024 * 1024), index,
+                       metrics)
+    else:
+        with metrics.stage("filter"):
+            filtered_folder = filter_midis(input_dir, suboutput, note_count, time_steps, fast_reject, jobs, cache,
+                                           link_mode, index, metrics)
+        with metrics.stage("split"):
+            splitted_folder = split_midis(filtered_folder, suboutput, min_length, max_length, seed, jobs, metrics)
+        with metrics.stage("separate"):
+            set_folder = separate_midis(splitted_folder, suboutput, seed, link_mode, metrics)
+        with metrics.stage("transform"):
+            transform_midis(set_folder, suboutput, time_steps, note_count, legacy_quantization, jobs, cache,
+                            output_format, int(buffer_size * 1024 * 1024), link_mode, metrics)
+
+    if cache is not None:
+        count, size = cache.prune()
+        click.echo("Removed {} cache entries with {}.".format(count, format_size(size)))
+    for stage in metrics.stages:
+        click.echo("{}: {} files in {:.1f}s, {:.1f}s CPU".format(stage["name"], stage["files"], stage["seconds"],
+                                                                stage["cpu_seconds"]))
+    if report_file is not None:
+        options = {"split_mode": split_mode}
+        if split_mode != "windows":
+            options.update(fused=fused, link_mode=link_mode, output_format=output_format)
+        metrics.save(report_file, input_dir=input_dir, output_dir=suboutput, note_count=note_count,
+                     time_steps=time_steps, min_length=min_length, max_length=max_length, jobs=jobs,
+                     cache=cache_dir is not None, **options)
+        click.echo("Saved report to {}.".format(report_file))
     click.echo("Done.")
 
 
@@ -0,0 +1,137 @@
+"""
+Persistent index of the files of a corpus with their size, modification time and hash
+Directories whose modification time did not change are listed from the index without being scanned,
+so later runs only stat the directories and pick up new or changed files
+"""
+
+import json
+import os
+from typing import List, Dict, Generator
+
+import click
+
+from files import get_file_hash, map_files
+
+INDEX_VERSION = 1
+
+
+class CorpusIndex:
+    def __init__(self, file: str, verify: bool = False):
+        self.file = file
+        # with verify the files of unchanged directories are checked too, for corpora edited in place
+        self.verify = verify
+        self.dirs: Dict[str, Dict[str, any]] = {}
+        self.files: Dict[str, List[any]] = {}
+        self.changed = False
+        if os.path.exists(file):
+            with open(file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == INDEX_VERSION:
+                self.dirs = data["dirs"]
+                self.files = data["files"]
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp_file = "{}.{}.tmp".format(self.file, os.getpid())
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "dirs": self.dirs, "files": self.files}, f)
+        os.replace(tmp_file, self.file)
+        self.changed = False
+
+    def update_file(self, path: str, stat: os.stat_result):
+        entry = self.files.get(path)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            self.files[path] = [stat.st_size, stat.st_mtime_ns, None]
+            self.changed = True
+
+    def remove_dir(self, folder: str):
+        entry = self.dirs.pop(folder, None)
+        if entry is None:
+            return
+        self.changed = True
+        for name in entry["files"]:
+            self.files.pop(os.path.join(folder, name), None)
+        for name in entry["dirs"]:
+            self.remove_dir(os.path.join(folder, name))
+
+    def scan_dir(self, folder: str) -> Dict[str, any]:
+        stat = os.stat(folder)
+        entry = self.dirs.get(folder)
+        if entry is not None and entry["mtime"] == stat.st_mtime_ns:
+            if self.verify:
+                for name in entry["files"]:
+                    path = os.path.join(folder, name)
+                    self.update_file(path, os.stat(path))
+            return entry
+
+        files = []
+        dirs = []
+        with os.scandir(folder) as entries:
+            for dir_entry in entries:
+                if dir_entry.is_file():
+                    files.append(dir_entry.name)
+                    self.update_file(dir_entry.path, dir_entry.stat())
+                elif dir_entry.is_dir():
+                    dirs.append(dir_entry.name)
+        if entry is not None:
+            for name in set(entry["files"]) - set(files):
+                self.files.pop(os.path.join(folder, name), None)
+            for name in set(entry["dirs"]) - set(dirs):
+                self.remove_dir(os.path.join(folder, name))
+        entry = {"mtime": stat.st_mtime_ns, "files": files, "dirs": dirs}
+        self.dirs[folder] = entry
+        self.changed = True
+        return entry
+
+    def iterate_files(self, dir: str, extension: str = None, recursive: bool = False) -> Generator[str, None, None]:
+        folder = os.path.abspath(dir)
+        try:
+            entry = self.scan_dir(folder)
+        except FileNotFoundError:
+            self.remove_dir(folder)
+            return
+        for name in entry["files"]:
+            if extension is None or name.endswith("." + extension):
+                yield os.path.join(folder, name)
+        if recursive:
+            for name in entry["dirs"]:
+                yield from self.iterate_files(os.path.join(folder, name), extension, recursive)
+
+    def get_files(self, dir: str, extension: str = None, recursive: bool = False) -> List[str]:
+        return list(self.iterate_files(dir, extension, recursive))
+
+    def get_hashes(self, files: List[str], jobs: int = 1) -> List[str]:
+        missing = [file for file in files if self.files[file][2] is None]
+        for file, file_hash in zip(missing, map_files(get_file_hash, missing, jobs)):
+            self.files[file][2] = file_hash
+        if len(missing) > 0:
+            self.changed = True
+        return [self.files[file][2] for file in files]
+
+
+@click.command()
+@click.option("input_dir", "--input", "-i", type=click.Path(exists=True, file_okay=False), required=True)
+@click.option("index_file", "--index", type=click.Path(dir_okay=False), required=True)
+@click.option("--recursive", "-r", is_flag=True, default=False, show_default=True)
+@click.option("--hash", "with_hash", is_flag=True, default=False, show_default=True)
+@click.option("--verify", is_flag=True, default=False, show_default=True,
+              help="Also stat the files of unchanged directories.")
+@click.option("--jobs", "-j", default=1, type=int, show_default=True)
+def main(input_dir: str,
+         index_file: str,
+         recursive: bool = False,
+         with_hash: bool = False,
+         verify: bool = False,
+         jobs: int = 1):
+    index = CorpusIndex(index_file, verify)
+    files = index.get_files(input_dir, "mid", recursive)
+    click.echo("Found {} files in {}.".format(len(files), input_dir))
+    if with_hash:
+        index.get_hashes(files, jobs)
+    index.save()
+    click.echo("Done.")
+
+
+if __name__ == '__main__':
+    main()
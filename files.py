@@ -0,0 +1,126 @@
+"""
+Finding, listing, linking and hashing files and mapping functions over them in parallel
+Only the standard library is needed, so the commands working on files alone start without numpy and pretty_midi
+"""
+
+import hashlib
+import os
+import shutil
+from collections import deque
+from typing import List, Generator, Iterable
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def scan_files(dir: str, extension: str = None, recursive: bool = False) -> Generator[str, None, None]:
+    # scandir knows the entry types from the listing, so no extra stat per entry is needed
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                if extension is None or entry.name.endswith("." + extension):
+                    yield entry.path
+            elif recursive and entry.is_dir():
+                yield from scan_files(entry.path, extension, recursive)
+
+
+def get_files(dir: str, extension: str = None, recursive: bool = False) -> List[str]:
+    return list(scan_files(dir, extension, recursive))
+
+
+LINK_MODES = ["copy", "hardlink", "symlink", "manifest"]
+MANIFEST_EXTENSION = ".txt"
+
+
+def write_manifest(files: Iterable[str], file: str):
+    with open(file, "w", encoding="utf-8") as f:
+        for path in files:
+            f.write(os.path.abspath(path) + "\n")
+
+
+def read_manifest(file: str) -> List[str]:
+    with open(file, "r", encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def get_stage_files(path: str, extension: str = None) -> List[str]:
+    # the output of a stage is either a folder or a manifest listing its files
+    if os.path.isfile(path):
+        return read_manifest(path)
+    return get_files(path, extension)
+
+
+def link_file(origin: str, dest: str, mode: str = "copy"):
+    if os.path.lexists(dest):
+        if os.path.exists(dest) and os.path.samefile(origin, dest):
+            return
+        os.remove(dest)
+    if mode == "hardlink":
+        try:
+            os.link(origin, dest)
+            return
+        except OSError:
+            # links can not cross file systems, those files are copied
+            pass
+    elif mode == "symlink":
+        os.symlink(os.path.abspath(origin), dest)
+        return
+    shutil.copy(origin, dest)
+
+
+def get_file_hash(file: str) -> str:
+    result = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            result.update(chunk)
+    return result.hexdigest()
+
+
+def map_files(function, files: List[str], jobs: int = 1, metrics=None) -> List[any]:
+    # results keep the order of files, so the output does not depend on the worker count
+    # metrics is an optional metrics.Metrics which measures every file and shows the progress
+    if metrics is not None:
+        # iterate_files keeps the order as well and hands over the results one by one for the progress
+        return list(iterate_files(function, files, jobs, metrics=metrics))
+    if jobs <= 1 or len(files) <= 1:
+        return [function(file) for file in files]
+    # multiprocessing takes a while to import, only parallel runs need it
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(function, files, chunksize=max(1, len(files) // (jobs * 4))))
+
+
+def iterate_files(function, files: Iterable[str], jobs: int = 1, window: int = 4,
+                  metrics=None) -> Iterable[any]:
+    # like map_files, but only window results per worker are in flight and they are yielded as soon as possible
+    if metrics is not None:
+        total = len(files) if hasattr(files, "__len__") else None
+        yield from metrics.collect(iterate_files(metrics.wrap(function, jobs), files, jobs, window), total)
+        return
+    if jobs <= 1:
+        for file in files:
+            yield function(file)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for file in files:
+            pending.append(executor.submit(function, file))
+            if len(pending) >= jobs * window:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def get_file_name(path: str) -> str:
+    fullname = os.path.basename(path)
+    ext_point = fullname.rfind(".")
+    if ext_point != -1:
+        return fullname[:ext_point]
+    return fullname
+
+
+def get_and_create_folder_path(folder: str, name: str) -> str:
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
@@ -0,0 +1,352 @@
+"""
+Metrics of the stages of a run and of the files they process
+Stages are measured with wall and CPU time, bytes read and written, note counts and peak memory,
+files are measured in the process working on them and a progress line with files/s and the remaining time
+replaces their messages
+The peak memory of a stage or file is the high-water mark of the resident memory since its start, which linux
+resets on request, elsewhere it is not measured
+With a profile folder every stage is profiled into a pstats dump, with a threshold only the files taking longer
+are kept, each in a dump of its own
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import time
+from contextlib import contextmanager, redirect_stdout
+from functools import partial
+from typing import List, Dict, Tuple, Iterable
+
+import click
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPORT_VERSION = 1
+PROGRESS_INTERVAL = 0.2
+# without a terminal the progress goes to a log, where every update is a new line
+LOG_PROGRESS_INTERVAL = 10
+
+# the high-water mark of this process before its last reset, a file resets it inside of a stage
+_previous_peak = 0
+
+
+def get_io_counters() -> Tuple[int, int]:
+    # bytes read and written by the process including the cache, only linux counts them
+    try:
+        with open("/proc/self/io", "r") as f:
+            values = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(values["rchar"]), int(values["wchar"])
+    except (IOError, ValueError, KeyError):
+        return None, None
+
+
+def get_peak_memory(children: bool = False) -> int:
+    # the high-water mark of the whole process or of its ended children, not reset by the stages
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def read_high_water_mark() -> int:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def reset_peak_memory() -> bool:
+    global _previous_peak
+    peak = read_high_water_mark()
+    if peak is None:
+        return False
+    _previous_peak = max(_previous_peak, peak)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except IOError:
+        return False
+    return True
+
+
+def get_cpu_time(children: bool = False) -> float:
+    # children are only counted once they ended, which the workers of a stage did at its end
+    times = os.times()
+    if children:
+        return times.children_user + times.children_system
+    return times.user + times.system
+
+
+def get_difference(end: int, start: int) -> int:
+    return end - start if end is not None and start is not None else None
+
+
+def get_item_file(item) -> str:
+    # the functions of the stages get a file or a tuple starting with the file
+    return item[0] if isinstance(item, tuple) else item
+
+
+def measure_file(item, function, quiet: bool = False,
+                 profile: bool = False,
+                 profile_threshold: float = None,
+                 profile_prefix: str = None,
+                 count_notes=None) -> Tuple[any, Dict[str, any]]:
+    # count_notes is an optional function giving the note count of a file, it reads the file once more
+    record = {"file": get_item_file(item), "notes": 0}
+    profiler = cProfile.Profile() if profile else None
+    measure_memory = reset_peak_memory()
+    read_start, written_start = get_io_counters()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        if quiet:
+            with redirect_stdout(io.StringIO()):
+                result = function(item)
+        else:
+            result = function(item)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    record["seconds"] = time.perf_counter() - start
+    record["cpu_seconds"] = time.process_time() - cpu_start
+    read_end, written_end = get_io_counters()
+    record["bytes_read"] = get_difference(read_end, read_start)
+    record["bytes_written"] = get_difference(written_end, written_start)
+    record["peak_memory"] = read_high_water_mark() if measure_memory else None
+    record["process"] = os.getpid()
+    if count_notes is not None:
+        record["notes"] = count_notes(record["file"])
+    if profiler is not None:
+        if profile_threshold is None:
+            # the stats go back to the stage, which adds them to its own dump
+            profiler.create_stats()
+            record["profile_stats"] = profiler.stats
+        elif record["seconds"] > profile_threshold:
+            path = "{}.{}.pstats".format(profile_prefix, os.path.splitext(os.path.basename(record["file"]))[0])
+            profiler.dump_stats(path)
+            record["profile"] = path
+    return result, record
+
+
+class WorkerProfile:
+    # the stats of a profile made in a worker, pstats loads them like the ones of a profiler
+    def __init__(self, stats: Dict[tuple, tuple]):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+    return "{}:{:02d}".format(minutes, seconds)
+
+
+class Progress:
+    def __init__(self, name: str, total: int = None):
+        self.name = name
+        self.total = total
+        self.count = 0
+        self.start = time.perf_counter()
+        self.last_update = None
+        self.interactive = sys.stderr.isatty()
+
+    def get_line(self) -> str:
+        seconds = time.perf_counter() - self.start
+        rate = self.count / seconds if seconds > 0 else 0
+        if self.total is None:
+            return "{}: {} files, {:.1f} files/s".format(self.name, self.count, rate)
+        line = "{}: {}/{} files, {:.1f} files/s".format(self.name, self.count, self.total, rate)
+        if rate > 0:
+            line += ", ETA {}".format(format_duration((self.total - self.count) / rate))
+        return line
+
+    def update(self, count: int = 1):
+        self.count += count
+        now = time.perf_counter()
+        interval = PROGRESS_INTERVAL if self.interactive else LOG_PROGRESS_INTERVAL
+        if self.last_update is not None and now - self.last_update < interval:
+            return
+        self.last_update = now
+        if self.interactive:
+            click.echo("\r" + self.get_line() + "\033[K", nl=False, err=True)
+        else:
+            click.echo(self.get_line(), err=True)
+
+    def close(self):
+        if self.interactive:
+            click.echo("\r" + self.get_line() + "\033[K", err=True)
+        elif self.count > 0:
+            click.echo(self.get_line(), err=True)
+
+
+class Metrics:
+    def __init__(self, quiet: bool = True, progress: bool = True,
+                 profile_dir: str = None,
+                 profile_threshold: float = None,
+                 count_notes=None):
+        # quiet drops the messages of the files, the stages still report what they do
+        # count_notes is an optional function giving the note count of a file, without it the notes stay 0
+        self.quiet = quiet
+        self.count_notes = count_notes
+        self.progress = progress
+        self.profile_dir = profile_dir
+        self.profile_threshold = profile_threshold
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+        self.worker_stats: pstats.Stats = None
+        self.slow_files: List[Dict[str, any]] = []
+        self.stages: List[Dict[str, any]] = []
+        self.files: List[Dict[str, any]] = []
+        self.current_stage: Dict[str, any] = None
+        # bytes read and written by the workers of the current stage and the peak memory of their files
+        self.worker_bytes = [0, 0]
+        self.worker_peak: int = None
+
+    @contextmanager
+    def stage(self, name: str):
+        global _previous_peak
+        record = {"name": name, "files": 0, "notes": 0}
+        self.current_stage = record
+        self.worker_bytes = [0, 0]
+        self.worker_peak = None
+        self.worker_stats = None
+        self.slow_files = []
+        profiler = None
+        if self.profile_dir is not None and self.profile_threshold is None:
+            profiler = cProfile.Profile()
+        measure_memory = reset_peak_memory()
+        _previous_peak = 0
+        read_start, written_start = get_io_counters()
+        cpu_start = get_cpu_time()
+        children_cpu_start = get_cpu_time(children=True)
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self.current_stage = None
+            record["seconds"] = time.perf_counter() - start
+            record["cpu_seconds"] = (get_cpu_time() - cpu_start +
+                                     get_cpu_time(children=True) - children_cpu_start)
+            read_end, written_end = get_io_counters()
+            read = get_difference(read_end, read_start)
+            written = get_difference(written_end, written_start)
+            record["bytes_read"] = read + self.worker_bytes[0] if read is not None else None
+            record["bytes_written"] = written + self.worker_bytes[1] if written is not None else None
+            peak = read_high_water_mark() if measure_memory else None
+            record["peak_memory"] = max(peak, _previous_peak) if peak is not None else None
+            record["peak_worker_memory"] = self.worker_peak
+            if profiler is not None:
+                record["profile"] = self.save_stage_profile(name, profiler)
+            for file in self.slow_files:
+                click.echo("{}: {} took {:.1f}s, profile in {}".format(name, file["file"], file["seconds"],
+                                                                      file["profile"]))
+            self.stages.append(record)
+
+    def save_stage_profile(self, name: str, profiler: cProfile.Profile) -> str:
+        stats = pstats.Stats(profiler)
+        if self.worker_stats is not None:
+            stats.add(self.worker_stats)
+        path = os.path.join(self.profile_dir, "{}.pstats".format(name))
+        stats.dump_stats(path)
+        click.echo("Saved profile of {} to {}.".format(name, path))
+        return path
+
+    def wrap(self, function, jobs: int = 1):
+        # the stage profile only sees this process, so files in workers are profiled on their own
+        profile = self.profile_dir is not None and (self.profile_threshold is not None or jobs > 1)
+        profile_prefix = None
+        if profile:
+            name = self.current_stage["name"] if self.current_stage is not None else "files"
+            profile_prefix = os.path.join(self.profile_dir, name)
+        return partial(measure_file, function=function, quiet=self.quiet, profile=profile,
+                       profile_threshold=self.profile_threshold, profile_prefix=profile_prefix,
+                       count_notes=self.count_notes)
+
+    def add_file(self, record: Dict[str, any]):
+        stats = record.pop("profile_stats", None)
+        if stats:
+            if self.worker_stats is None:
+                self.worker_stats = pstats.Stats(WorkerProfile(stats))
+            else:
+                self.worker_stats.add(WorkerProfile(stats))
+        if "profile" in record:
+            self.slow_files.append(record)
+        stage = self.current_stage
+        if stage is not None:
+            record["stage"] = stage["name"]
+            stage["files"] += 1
+            stage["notes"] += record["notes"]
+            # the counters of the stage only see this process, the workers add theirs
+            if record["process"] != os.getpid():
+                for i, name in enumerate(["bytes_read", "bytes_written"]):
+                    if record[name] is not None:
+                        self.worker_bytes[i] += record[name]
+                if record["peak_memory"] is not None:
+                    self.worker_peak = max(self.worker_peak or 0, record["peak_memory"])
+        self.files.append(record)
+
+    def add_listed_files(self, files: Iterable[str]):
+        # files a stage only lists in a manifest count for it without being measured
+        for file in files:
+            self.add_file({"file": file, "notes": 0, "seconds": 0.0, "cpu_seconds": 0.0, "bytes_read": None,
+                           "bytes_written": None, "peak_memory": None, "process": os.getpid()})
+
+    def collect(self, results: Iterable[Tuple[any, Dict[str, any]]], total: int = None,
+                name: str = None) -> Iterable[any]:
+        if name is None:
+            name = self.current_stage["name"] if self.current_stage is not None else "files"
+        progress = Progress(name, total) if self.progress else None
+        try:
+            for result, record in results:
+                self.add_file(record)
+                if progress is not None:
+                    progress.update()
+                yield result
+        finally:
+            if progress is not None:
+                progress.close()
+
+    def get_total(self) -> Dict[str, any]:
+        result = {"seconds": sum(stage["seconds"] for stage in self.stages),
+                  "cpu_seconds": sum(stage["cpu_seconds"] for stage in self.stages),
+                  "files": len(self.files)}
+        for name in ["bytes_read", "bytes_written"]:
+            values = [stage[name] for stage in self.stages]
+            result[name] = sum(values) if None not in values else None
+        for name in ["peak_memory", "peak_worker_memory"]:
+            values = [stage[name] for stage in self.stages if stage[name] is not None]
+            result[name] = max(values) if len(values) > 0 else None
+        return result
+
+    def save(self, file: str, **info):
+        report = {
+            "version": REPORT_VERSION,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "info": info,
+            "total": self.get_total(),
+            "stages": self.stages,
+            "files": self.files
+        }
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
@@ -3,42 +3,52 @@ Process small MIDI files into a Numpy-Trainingssetfile
 Files have to be in seperate folders for train, test and valid -> cli-options
 """
 
-from math import floor
+import queue
+import random
+import shutil
+import struct
+import tempfile
+import threading
+from functools import partial
 from typing import List, Dict
 import numpy as np
 
 from common import *
+from cache import Cache, get_cache_key, get_file_hash
+from metrics import Metrics
 
 import click
 
 
-def get_multiple_number_greater_than(factor: float, target: float):
-    tmp = target / factor
-    tmp = floor(tmp)
-    tmp = tmp * factor
-    if tmp < target:
-        return tmp + 1
-    return tmp
-
-
-def get_notes_from_instrument(instr: pretty_midi.Instrument, steps: float) -> Dict[float, List[pretty_midi.Note]]:
-    result: Dict[float, List[pretty_midi.Note]] = {}
-    for note in instr.notes:
-        note_time = timespan_from_note(note)
-        time = get_multiple_number_greater_than(steps, note_time.start)
-        while note_time.contains(time):
-            if time not in result:
-                result[time] = [note]
-            else:
-                result[time].append(note)
-            time += steps
-    return result
+# process_midi keeps every note and its own onset rounding
+QUANTIZE_RULES = {"legacy_onset": True}
+
+# legacy: pickled lists and float arrays with NaN for silence, ragged: one int8 array per set with offsets,
+# ragged_dir: the ragged arrays as uncompressed .npy files which can be memory mapped
+OUTPUT_FORMATS = ["legacy", "ragged", "ragged_dir"]
+RAGGED_EXTENSION = ".ragged.npz"
+RAGGED_DIR_EXTENSION = ".ragged"
+WINDOWS_EXTENSION = ".windows"
+NPY_HEADER_SIZE = 128
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+# the batches of a split, the training crops are shuffled and repeat until the trainer stops
+BATCH_CONFIGS = {
+    "train": {"batch_size": 20, "crop_length": 64, "shuffle": True, "epochs": None},
+    "test": {"batch_size": 20, "crop_length": 64, "shuffle": False, "epochs": 1},
+    "valid": {"batch_size": 20, "crop_length": 64, "shuffle": False, "epochs": 1}
+}
+DEFAULT_PREFETCH = 4
+# the bounds transposed pitches are clipped to, the whole MIDI range or the range of all voices
+PITCH_BOUNDS = {
+    "midi": (0, 127),
+    "voices": (min(voice[1][0] for voice in RANGE_VOICES), max(voice[1][1] for voice in RANGE_VOICES))
+}
 
 
 def get_notes_from_midi(mid: pretty_midi.PrettyMIDI, steps: float) -> Dict[float, List[pretty_midi.Note]]:
     result: Dict[float, List[pretty_midi.Note]] = {}
     for instr in mid.instruments:
-        extracted_notes = get_notes_from_instrument(instr, steps)
+        extracted_notes = get_notes_from_instrument(instr, steps, **QUANTIZE_RULES)
         for time, notes in extracted_notes.items():
             if time not in result:
                 result[time] = notes
@@ -47,6 +57,24 @@ def get_notes_from_midi(mid: pretty_midi.PrettyMIDI, steps: float) -> Dict[float
     return result
 
 
+def get_note_array_from_midi(mid: pretty_midi.PrettyMIDI, steps: float, desired_note_count: int,
+                             grid: NoteGrid = None) -> np.ndarray:
+    if grid is None:
+        grid = get_note_grid(mid, steps, **QUANTIZE_RULES)
+    else:
+        grid = grid.with_rules(**QUANTIZE_RULES)
+    return grid.to_array(desired_note_count)
+
+
+def note_array_to_notelists(notes: np.ndarray) -> List[List[int]]:
+    return [[None if pitch == SILENCE else pitch for pitch in step] for step in notes.tolist()]
+
+
+def notelists_to_note_array(notes: List[List[int]], desired_note_count: int) -> np.ndarray:
+    values = [[SILENCE if pitch is None else pitch for pitch in step] for step in notes]
+    return np.array(values, dtype=np.int8).reshape((len(values), desired_note_count))
+
+
 def normalize_notelists(notes: List[int], desired_note_count: int) -> List[int]:
     while len(notes) > desired_note_count:
         notes.pop(len(notes) - 1)
@@ -55,7 +83,11 @@ def normalize_notelists(notes: List[int], desired_note_count: int) -> List[int]:
     return notes
 
 
-def get_note_values_from_midi(mid: pretty_midi.PrettyMIDI, steps: float, desired_note_count: int) -> List[List[int]]:
+def get_note_values_from_midi(mid: pretty_midi.PrettyMIDI, steps: float, desired_note_count: int,
+                              legacy: bool = False) -> List[List[int]]:
+    if not legacy:
+        return note_array_to_notelists(get_note_array_from_midi(mid, steps, desired_note_count))
+
     notes = get_notes_from_midi(mid, steps)
     result: List[List[int]] = []
     time = 0
@@ -70,10 +102,52 @@ def get_note_values_from_midi(mid: pretty_midi.PrettyMIDI, steps: float, desired
     return result
 
 
+def read_note_grid(file: str, steps: float) -> NoteGrid:
+    # the notes are decoded without building pretty_midi objects
+    return get_note_grid_from_columns(read_midi_notes(file), steps, **QUANTIZE_RULES)
+
+
+def get_note_array_from_file(file: str, steps: float, desired_note_count: int,
+                             legacy: bool = False,
+                             cache: Cache = None) -> np.ndarray:
+    if legacy:
+        notes = get_note_values_from_midi(pretty_midi.PrettyMIDI(file), steps, desired_note_count, legacy)
+        return notelists_to_note_array(notes, desired_note_count)
+    if cache is None:
+        return get_note_array_from_midi(None, steps, desired_note_count, read_note_grid(file, steps))
+
+    key = get_cache_key(get_file_hash(file), steps=steps, desired_note_count=desired_note_count, **QUANTIZE_RULES)
+    notes = cache.get("grid", key)
+    if notes is None:
+        notes = {"notes": get_note_array_from_midi(None, steps, desired_note_count, read_note_grid(file, steps))}
+        cache.put("grid", key, notes)
+    return notes["notes"]
+
+
+def get_note_values_from_file(file: str, steps: float, desired_note_count: int,
+                              legacy: bool = False,
+                              cache: Cache = None) -> List[List[int]]:
+    if legacy:
+        return get_note_values_from_midi(pretty_midi.PrettyMIDI(file), steps, desired_note_count, legacy)
+    return note_array_to_notelists(get_note_array_from_file(file, steps, desired_note_count, legacy, cache))
+
+
+def get_all_note_values_from_files(files: List[str],
+                                   steps: float,
+                                   desired_note_count: int,
+                                   legacy: bool = False,
+                                   jobs: int = 1,
+                                   cache: Cache = None,
+                                   metrics: Metrics = None) -> List[List[List[int]]]:
+    return map_files(partial(get_note_values_from_file, steps=steps, desired_note_count=desired_note_count,
+                             legacy=legacy, cache=cache), files, jobs, metrics)
+
+
 def get_all_note_values(midis: List[pretty_midi.PrettyMIDI],
                         steps: float,
-                        desired_note_count: int) -> List[List[List[int]]]:
-    return [get_note_values_from_midi(mid, steps, desired_note_count) for mid in midis]
+                        desired_note_count: int,
+                        legacy: bool = False) -> List[List[List[int]]]:
+    return [get_note_values_from_midi(mid, steps, desired_note_count, legacy) for mid in midis]
 
 
 def transform_notes(notes: List[List[List[int]]]) -> any:
@@ -81,6 +155,55 @@ def transform_notes(notes: List[List[List[int]]]) -> any:
     return np.array(data, dtype=np.object)
 
 
+def gather_crops(notes: np.ndarray, starts: np.ndarray, lengths: np.ndarray,
+                 crop_length: int) -> Tuple[np.ndarray, np.ndarray]:
+    # crop_length steps from every start in the concatenated notes, steps past the length of a crop are silent
+    # and left out of the mask
+    steps = np.arange(crop_length)
+    mask = steps < np.asarray(lengths)[:, None]
+    positions = np.where(mask, np.asarray(starts)[:, None] + steps, 0)
+    result = np.asarray(notes[positions.reshape(-1)]).reshape(positions.shape + notes.shape[1:])
+    result[~mask] = SILENCE
+    return result, mask
+
+
+def get_ragged_piece(notes: np.ndarray, offsets: np.ndarray, index: int) -> np.ndarray:
+    return notes[offsets[index]:offsets[index + 1]]
+
+
+class RaggedNotes:
+    def __init__(self, notes: np.ndarray, offsets: np.ndarray):
+        self.notes = notes
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("piece index {} out of range".format(index))
+        return get_ragged_piece(self.notes, self.offsets, index)
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def note_count(self) -> int:
+        return self.notes.shape[1]
+
+    def get_steps(self, index: int, start: int = None, end: int = None) -> np.ndarray:
+        return self[index][start:end]
+
+    def get_crops(self, indices: np.ndarray, starts: np.ndarray, crop_length: int) -> Tuple[np.ndarray, np.ndarray]:
+        return gather_crops(self.notes, self.offsets[indices] + starts, self.lengths[indices] - starts, crop_length)
+
+
 def build_training_dict(notes_train: List[List[List[int]]],
                         notes_test: List[List[List[int]]],
                         notes_validate: List[List[List[int]]]) -> Dict[str, List[List[List[int]]]]:
@@ -114,6 +237,234 @@ def save_notes_with_numpy(notes: Dict[str, any], file: str):
         np.savez_compressed(f, **notes)
 
 
+def load_ragged_notes_with_numpy(file: str) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    result = None
+    with open(file, "rb") as f:
+        with np.load(f, allow_pickle=False) as npz:
+            result = {
+                name: (npz["{}_notes".format(name)], npz["{}_offsets".format(name)])
+                for name in ["train", "test", "valid"]
+            }
+    return result
+
+
+def open_ragged_notes(folder: str, mmap_mode: str = "r",
+                      names: Iterable[str] = ("train", "test", "valid")) -> Dict[str, RaggedNotes]:
+    # views into memory mapped files, pieces are only read when they are accessed
+    return {
+        name: RaggedNotes(np.load(os.path.join(folder, "{}_notes.npy".format(name)), mmap_mode=mmap_mode),
+                          np.load(os.path.join(folder, "{}_offsets.npy".format(name))))
+        for name in names
+    }
+
+
+class WindowedNotes:
+    def __init__(self, pieces: RaggedNotes, windows: np.ndarray):
+        # every row of windows is (piece, start_step, end_step)
+        self.pieces = pieces
+        self.windows = windows
+
+    def __len__(self) -> int:
+        return len(self.windows)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("window index {} out of range".format(index))
+        piece, start, end = self.windows[index]
+        return self.pieces[piece][start:end]
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self.windows[:, 2] - self.windows[:, 1]
+
+    @property
+    def note_count(self) -> int:
+        return self.pieces.note_count
+
+    def get_steps(self, index: int, start: int = None, end: int = None) -> np.ndarray:
+        return self[index][start:end]
+
+    def get_crops(self, indices: np.ndarray, starts: np.ndarray, crop_length: int) -> Tuple[np.ndarray, np.ndarray]:
+        pieces, window_starts, window_ends = self.windows[indices].T
+        return gather_crops(self.pieces.notes, self.pieces.offsets[pieces] + window_starts + starts,
+                            window_ends - window_starts - starts, crop_length)
+
+
+def open_windowed_notes(folder: str, mmap_mode: str = "r",
+                        names: Iterable[str] = ("train", "test", "valid")) -> Dict[str, WindowedNotes]:
+    pieces = open_ragged_notes(folder, mmap_mode, ["pieces"])["pieces"]
+    return {
+        name: WindowedNotes(pieces, np.load(os.path.join(folder, "{}_windows.npy".format(name))))
+        for name in names
+    }
+
+
+def transpose_notes(notes: np.ndarray, shifts: any, bounds: Tuple[int, int] = PITCH_BOUNDS["midi"]) -> np.ndarray:
+    # shifts is one value or one per piece of a batch of pieces, silence stays silence
+    shifts = np.asarray(shifts)
+    shifts = shifts.reshape(shifts.shape + (1,) * (notes.ndim - shifts.ndim))
+    if np.issubdtype(notes.dtype, np.floating):
+        # the legacy arrays mark silence with NaN, which stays NaN
+        return np.clip(notes + shifts, bounds[0], bounds[1]).astype(notes.dtype)
+    transposed = np.clip(notes.astype(np.int16) + shifts, bounds[0], bounds[1])
+    return np.where(notes == SILENCE, notes, transposed).astype(notes.dtype)
+
+
+class TransposedNotes:
+    def __init__(self, notes: any, shifts: Iterable[int] = range(-6, 6),
+                 bounds: Tuple[int, int] = PITCH_BOUNDS["midi"]):
+        # every piece of notes in every transposition, piece i shifted by shifts[j] is item i * len(shifts) + j,
+        # the pieces are only transposed when they are accessed
+        self.notes = notes
+        self.shifts = np.array(list(shifts), dtype=np.int64)
+        self.bounds = bounds
+
+    def __len__(self) -> int:
+        return len(self.notes) * len(self.shifts)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("transposed piece index {} out of range".format(index))
+        piece, shift = divmod(index, len(self.shifts))
+        return transpose_notes(self.notes[piece], self.shifts[shift], self.bounds)
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.repeat(self.notes.lengths, len(self.shifts))
+
+    @property
+    def note_count(self) -> int:
+        return self.notes.note_count
+
+    def get_pieces(self, indices: np.ndarray) -> np.ndarray:
+        return np.asarray(indices) // len(self.shifts)
+
+    def get_shifts(self, indices: np.ndarray) -> np.ndarray:
+        return self.shifts[np.asarray(indices) % len(self.shifts)]
+
+    def get_steps(self, index: int, start: int = None, end: int = None) -> np.ndarray:
+        piece, shift = divmod(index, len(self.shifts))
+        return transpose_notes(self.notes.get_steps(piece, start, end), self.shifts[shift], self.bounds)
+
+    def transpose_batch(self, batch: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        # a batch of steps cut from the untransposed pieces of indices
+        return transpose_notes(batch, self.get_shifts(indices), self.bounds)
+
+    def get_crops(self, indices: np.ndarray, starts: np.ndarray, crop_length: int) -> Tuple[np.ndarray, np.ndarray]:
+        batch, mask = self.notes.get_crops(self.get_pieces(indices), starts, crop_length)
+        return self.transpose_batch(batch, indices), mask
+
+
+def get_npy_header(dtype: np.dtype, shape: Tuple[int, ...]) -> bytes:
+    header = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": tuple(shape)})
+    # padded to a fixed size, so the final shape can be written over the placeholder
+    header = header.ljust(NPY_HEADER_SIZE - 11) + "\n"
+    return np.lib.format.magic(1, 0) + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class NpyAppender:
+    def __init__(self, path: str, dtype: any, row_shape: Tuple[int, ...] = ()):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.rows = 0
+        self.file = open(path, "wb")
+        self.file.write(get_npy_header(self.dtype, (0,) + self.row_shape))
+
+    def append(self, values: np.ndarray):
+        values = np.ascontiguousarray(values, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        self.file.write(values.tobytes())
+        self.rows += len(values)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(get_npy_header(self.dtype, (self.rows,) + self.row_shape))
+        self.file.close()
+
+
+class RaggedNotesWriter:
+    def __init__(self, folder: str, desired_note_count: int,
+                 names: Iterable[str] = ("train", "test", "valid"),
+                 buffer_size: int = DEFAULT_BUFFER_SIZE):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.desired_note_count = desired_note_count
+        self.buffer_size = buffer_size
+        self.notes = {name: NpyAppender(os.path.join(folder, "{}_notes.npy".format(name)), np.int8,
+                                        (desired_note_count,)) for name in names}
+        self.offsets = {name: NpyAppender(os.path.join(folder, "{}_offsets.npy".format(name)), np.int64)
+                        for name in names}
+        self.buffers: Dict[str, List[np.ndarray]] = {name: [] for name in names}
+        self.ends = {name: 0 for name in names}
+        self.buffered_size = 0
+        for offsets in self.offsets.values():
+            offsets.append(np.zeros(1, dtype=np.int64))
+
+    def append(self, name: str, piece: np.ndarray):
+        piece = np.asarray(piece, dtype=np.int8).reshape((-1, self.desired_note_count))
+        self.buffers[name].append(piece)
+        self.buffered_size += piece.nbytes
+        if self.buffered_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for name, pieces in self.buffers.items():
+            if len(pieces) == 0:
+                continue
+            ends = self.ends[name] + np.cumsum([len(piece) for piece in pieces])
+            for piece in pieces:
+                self.notes[name].append(piece)
+            self.offsets[name].append(ends)
+            self.ends[name] = int(ends[-1])
+            pieces.clear()
+        self.buffered_size = 0
+
+    def close(self):
+        self.flush()
+        for appender in list(self.notes.values()) + list(self.offsets.values()):
+            appender.close()
+
+    def abort(self):
+        # the headers of an interrupted run are never finished, with them the folder would load as complete data
+        for appender in list(self.notes.values()) + list(self.offsets.values()):
+            appender.file.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self) -> "RaggedNotesWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except BaseException:
+            self.abort()
+            raise
+
+
+def compress_ragged_folder(folder: str, file: str):
+    # numpy writes the memory mapped arrays in chunks, so this does not load them either
+    notes = open_ragged_notes(folder)
+    arrays = {}
+    for name, ragged in notes.items():
+        arrays["{}_notes".format(name)] = ragged.notes
+        arrays["{}_offsets".format(name)] = ragged.offsets
+    save_notes_with_numpy(arrays, file)
+
+
 def load_notes_with_pickle(file: str) -> Dict[str, List[List[List[int]]]]:
     result = None
     with open(file, "rb") as f:
@@ -138,27 +489,137 @@ def load_notes_with_numpy(file: str) -> Dict[str, any]:
     return result
 
 
+_PREFETCH_END = object()
+
+
+def prefetch(items: Iterable[any], size: int = DEFAULT_PREFETCH) -> Generator[any, None, None]:
+    # a background thread keeps up to size items ready, errors are raised where the items are taken
+    ready = queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item: any):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                put((item, None))
+            put((_PREFETCH_END, None))
+        except Exception as e:
+            put((None, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error
+            if item is _PREFETCH_END:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class NoteBatches:
+    def __init__(self, notes: any,
+                 batch_size: int = 20,
+                 crop_length: int = 64,
+                 shuffle: bool = True,
+                 epochs: int = 1,
+                 seed: int = None,
+                 prefetch: int = DEFAULT_PREFETCH,
+                 drop_last: bool = False):
+        # notes are RaggedNotes, WindowedNotes or TransposedNotes, every batch is a (batch, crop_length, note_count)
+        # array with a (batch, crop_length) mask of the steps inside the pieces, epochs None repeats forever
+        self.notes = notes
+        self.batch_size = batch_size
+        self.crop_length = crop_length
+        self.shuffle = shuffle
+        self.epochs = epochs
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.prefetch = prefetch
+        self.drop_last = drop_last
+        self.lengths = np.asarray(notes.lengths)
+        self.items = np.flatnonzero(self.lengths > 0)
+
+    def __len__(self) -> int:
+        # the batches of one epoch
+        if self.drop_last:
+            return len(self.items) // self.batch_size
+        return -(-len(self.items) // self.batch_size)
+
+    def get_epoch_batches(self, epoch: int) -> Generator[Tuple[np.ndarray, np.ndarray], None, None]:
+        # every epoch has its own generator, so an epoch is the same whatever was read before
+        rng = np.random.default_rng([self.seed, epoch])
+        items = rng.permutation(self.items) if self.shuffle else self.items
+        starts = rng.integers(0, np.maximum(self.lengths[items] - self.crop_length, 0) + 1)
+        for i in range(len(self)):
+            batch = slice(i * self.batch_size, (i + 1) * self.batch_size)
+            yield self.notes.get_crops(items[batch], starts[batch], self.crop_length)
+
+    def iterate_batches(self) -> Generator[Tuple[np.ndarray, np.ndarray], None, None]:
+        epoch = 0
+        while self.epochs is None or epoch < self.epochs:
+            yield from self.get_epoch_batches(epoch)
+            epoch += 1
+
+    def __iter__(self):
+        if self.prefetch > 0:
+            return prefetch(self.iterate_batches(), self.prefetch)
+        return self.iterate_batches()
+
+
+def open_batches(notes: Dict[str, any], configs: Dict[str, Dict[str, any]] = None,
+                 seed: int = None) -> Dict[str, NoteBatches]:
+    # configs override BATCH_CONFIGS per split, every split gets its own seed
+    if seed is None:
+        seed = random.getrandbits(32)
+    result = {}
+    for name, split_notes in notes.items():
+        config = dict(BATCH_CONFIGS.get(name, {}), **(configs or {}).get(name, {}))
+        config.setdefault("seed", random.Random("{}:{}".format(seed, name)).getrandbits(32))
+        result[name] = NoteBatches(split_notes, **config)
+    return result
+
+
 def build_trainingsdata(train_dir: str,
                         test_dir: str,
                         valid_dir: str,
                         steps: float,
-                        desired_note_count: int
+                        desired_note_count: int,
+                        legacy: bool = False,
+                        jobs: int = 1,
+                        cache: Cache = None,
+                        metrics: Metrics = None
                         ) -> Dict[str, List[List[List[int]]]]:
     # load midis
     click.echo("Loading training files from {}...".format(train_dir))
-    train_midis = load_midis(train_dir)
+    train_files = get_stage_files(train_dir, "mid")
     click.echo("Loading testing files from {}...".format(test_dir))
-    test_midis = load_midis(test_dir)
+    test_files = get_stage_files(test_dir, "mid")
     click.echo("Loading validation files from {}...".format(valid_dir))
-    valid_midis = load_midis(valid_dir)
+    valid_files = get_stage_files(valid_dir, "mid")
 
     # extract notes
     click.echo("Processing training files...")
-    train_notes = get_all_note_values(train_midis, steps, desired_note_count)
+    train_notes = get_all_note_values_from_files(train_files, steps, desired_note_count, legacy, jobs, cache,
+                                                 metrics)
     click.echo("Processing testing files...")
-    test_notes = get_all_note_values(test_midis, steps, desired_note_count)
+    test_notes = get_all_note_values_from_files(test_files, steps, desired_note_count, legacy, jobs, cache,
+                                                metrics)
     click.echo("Processing validation files...")
-    valid_notes = get_all_note_values(valid_midis, steps, desired_note_count)
+    valid_notes = get_all_note_values_from_files(valid_files, steps, desired_note_count, legacy, jobs, cache,
+                                                 metrics)
 
     click.echo("Combining processed data...")
     return build_training_dict(train_notes, test_notes, valid_notes)
@@ -171,29 +632,122 @@ def save_trainingsdata(notes: Dict[str, List[List[List[int]]]], filename: str):
     save_notes_with_numpy(transform_training_dict(notes), filename + ".npz")
 
 
+class RaggedTrainingsdataWriter(RaggedNotesWriter):
+    def __init__(self, filename: str, desired_note_count: int,
+                 output_format: str = "ragged",
+                 buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self.filename = filename
+        self.output_format = output_format
+        if output_format == "ragged_dir":
+            folder = filename + RAGGED_DIR_EXTENSION
+            click.echo("Writing ragged int8 notes into {}...".format(folder))
+        else:
+            folder = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(filename)))
+        super().__init__(folder, desired_note_count, buffer_size=buffer_size)
+
+    def close(self):
+        super().close()
+        if self.output_format != "ragged_dir":
+            click.echo("Saving ragged int8 notes with numpy...")
+            file = self.filename + RAGGED_EXTENSION
+            try:
+                compress_ragged_folder(self.folder, file)
+            except BaseException:
+                if os.path.exists(file):
+                    os.remove(file)
+                raise
+            finally:
+                shutil.rmtree(self.folder)
+
+
+def save_ragged_trainingsdata(notes: Dict[str, List[np.ndarray]], filename: str, desired_note_count: int,
+                              output_format: str = "ragged",
+                              buffer_size: int = DEFAULT_BUFFER_SIZE):
+    with RaggedTrainingsdataWriter(filename, desired_note_count, output_format, buffer_size) as writer:
+        for name, pieces in notes.items():
+            for piece in pieces:
+                writer.append(name, piece)
+
+
+def write_ragged_trainingsdata(train_dir: str,
+                               test_dir: str,
+                               valid_dir: str,
+                               steps: float,
+                               desired_note_count: int,
+                               filename: str,
+                               output_format: str = "ragged",
+                               legacy: bool = False,
+                               jobs: int = 1,
+                               cache: Cache = None,
+                               buffer_size: int = DEFAULT_BUFFER_SIZE,
+                               metrics: Metrics = None):
+    function = partial(get_note_array_from_file, steps=steps, desired_note_count=desired_note_count,
+                       legacy=legacy, cache=cache)
+    with RaggedTrainingsdataWriter(filename, desired_note_count, output_format, buffer_size) as writer:
+        for name, folder in [("train", train_dir), ("test", test_dir), ("valid", valid_dir)]:
+            click.echo("Processing {} files from {}...".format(name, folder))
+            for piece in iterate_files(function, get_stage_files(folder, "mid"), jobs, metrics=metrics):
+                writer.append(name, piece)
+
+
 @click.command()
-@click.option("train_dir", "--train", type=click.Path(exists=True, file_okay=False), required=True)
-@click.option("test_dir", "--test", type=click.Path(exists=True, file_okay=False), required=True)
-@click.option("valid_dir", "--valid", type=click.Path(exists=True, file_okay=False), required=True)
+@click.option("train_dir", "--train", type=click.Path(exists=True), required=True)
+@click.option("test_dir", "--test", type=click.Path(exists=True), required=True)
+@click.option("valid_dir", "--valid", type=click.Path(exists=True), required=True)
 @click.option("out", "-o", type=str, required=True)
-@click.option("--steps", default=0.125, type=float, show_default=True)
+@click.option("--steps", default=0.125, type=float, show_default=True,
+              help="Step length in seconds. The pitches per step match the old quantization only for lengths "
+                   "that are exact in binary like 0.125, the old float steps of --legacy do not end for "
+                   "lengths like 0.1.")
 @click.option("--desired_note_count", "--notes", default=4, type=int, show_default=True)
+@click.option("--legacy", is_flag=True, default=False, show_default=True)
+@click.option("--jobs", "-j", default=1, type=int, show_default=True)
+@click.option("cache_dir", "--cache_dir", type=click.Path(file_okay=False), default=None)
+@click.option("--cache_size", default=4096, type=float, show_default=True, help="Cache size limit in MB.")
+@click.option("output_format", "--format", default="legacy", type=click.Choice(OUTPUT_FORMATS), show_default=True)
+@click.option("--buffer_size", default=64, type=float, show_default=True,
+              help="Memory for pieces waiting to be written in MB, ragged formats only.")
+@click.option("profile_dir", "--profile", type=click.Path(file_okay=False), default=None,
+              help="Folder for a pstats dump of the run.")
+@click.option("--profile_threshold", default=None, type=float,
+              help="Only keep the profiles of files taking longer than this many seconds.")
 def main(train_dir: str,
          test_dir: str,
          valid_dir: str,
          out: str,
          steps: float,
-         desired_note_count: int):
+         desired_note_count: int,
+         legacy: bool = False,
+         jobs: int = 1,
+         cache_dir: str = None,
+         cache_size: float = 4096,
+         output_format: str = "legacy",
+         buffer_size: float = 64,
+         profile_dir: str = None,
+         profile_threshold: float = None):
     click.echo("Processing files with steps={} and note_count={}...".format(steps, desired_note_count))
-    notes = build_trainingsdata(
-        train_dir,
-        test_dir,
-        valid_dir,
-        steps,
-        desired_note_count
-    )
-    click.echo("Saving data...")
-    save_trainingsdata(notes, out)
+    cache = Cache(cache_dir, int(cache_size * 1024 * 1024)) if cache_dir is not None else None
+    metrics = Metrics(False, False, profile_dir, profile_threshold)
+    with metrics.stage("transform"):
+        if output_format != "legacy":
+            write_ragged_trainingsdata(train_dir, test_dir, valid_dir, steps, desired_note_count, out, output_format,
+                                       legacy, jobs, cache, int(buffer_size * 1024 * 1024), metrics)
+        else:
+            notes = build_trainingsdata(
+                train_dir,
+                test_dir,
+                valid_dir,
+                steps,
+                desired_note_count,
+                legacy,
+                jobs,
+                cache,
+                metrics
+            )
+            click.echo("Saving data...")
+            save_trainingsdata(notes, out)
+    if cache is not None:
+        cache.prune()
     click.echo("Done.")
 
 
@@ -1,225 +1,175 @@
 """Testing note reduction but it's not really good working"""
 
-from math import floor
-from typing import List, Dict
+from functools import partial
+from typing import Dict, Tuple
 import numpy as np
 
 from common import *
+from corpus_index import CorpusIndex
+from metrics import Metrics
 
 import click
 
 
-class InstrNote:
-    def __init__(self, instr: int, pitch: int):
-        self.pitch = pitch
-        self.instr = instr
-
-    def __add__(self, other):
-        self.pitch = self.pitch + other
-        return self
-
-    def __hash__(self):
-        return hash((self.instr, self.pitch))
-
-    def __eq__(self, other):
-        if self is not None and other is not None:
-            return self.pitch == other.pitch and self.instr == other.instr
-        if self is None and other is None:
-            return True
-        return False
-
-
-def sortInstrNotes(notes: List[InstrNote]) -> List[InstrNote]:
-    return sorted(notes, key=lambda x: x.pitch)
-
-
-def is_grundton(values: List[InstrNote]) -> List[InstrNote]:  # Grundton ist doppelt
-    for i in range(1, len(values)):
-        if values[0] + 4 == values[i]:  # Dur Akkord
-            for j in range(i + 1, len(values)):
-                if values[i] + 3 == values[j] or values[i] + 4 == values[j]:
-                    return [values[0], values[i], values[j], values[0] + 12]
-        elif values[0] + 3 == values[i]:  # Moll Akkord
-            for j in range(i + 1, len(values)):
-                if values[i] + 4 == values[j] or values[i] + 3 == values[j]:
-                    return [values[0], values[i], values[j], values[0] + 12]
-
-
-def is_quinte(values: List[InstrNote]) -> List[InstrNote]:  # Quinte ist doppelt
-    for i in range(1, len(values)):
-        if values[0] + 5 == values[i]:  # Dur Akkord
-            for j in range(i + 1, len(values)):
-                if values[i] + 4 == values[j] or values[i] + 3 == values[j]:
-                    return [values[0], values[i], values[j], values[0] + 12]
-        elif values[0] + 6 == values[i]:  # Moll Akkord
-            for j in range(i + 1, len(values)):
-                if values[i] + 3 == values[j]:
-                    return [values[0], values[i], values[j], values[0] + 12]
-
-
-def is_terz(values: List[InstrNote]) -> List[InstrNote]:  # Terz ist doppelt
-    for i in range(1, len(values)):
-        if values[0] + 3 == values[i]:  # Dur Akkord
-            for j in range(i + 1, len(values)):
-                if values[i] + 5 == values[j] or values[i] + 6 == values[j]:
-                    return [values[0], values[i], values[j], values[0] + 12]
-        elif values[0] + 4 == values[i]:  # Moll Akkord
-            for j in range(i + 1, len(values)):
-                if values[i] + 5 == values[j]:
-                    return [values[0], values[i], values[j], values[0] + 12]
-
-
-PITCH_FUNCTIONS = [is_grundton, is_quinte, is_terz]
-
-
-def transform_pitches(notes: List[InstrNote], double_index: int) -> List[InstrNote]:
-    return [(note + 12 if i < double_index else note) for i, note in enumerate(notes)]
-
-
-def get_base_pitches(notes: List[InstrNote], double_index: int) -> List[InstrNote]:
-    values = transform_pitches(notes, double_index)
-    values = sortInstrNotes(values)
-    for func in PITCH_FUNCTIONS:
-        result = func(values)
-        if result is not None:
-            return result
-    return None
-
-
-def get_double_pitch(notes: List[InstrNote]) -> int:
-    notes = sortInstrNotes(notes)
-    for i, n in enumerate(notes):
-        for note in notes:
-            if n + 12 == note:
-                return i
-    return -1
-
-
-def get_multiple_number_greater_than(factor: float, target: float):
-    tmp = target / factor
-    tmp = floor(tmp)
-    result = tmp * factor
-    if result < target:
-        tmp += 1
-        result = tmp * factor
-    return result
-
-
-def get_notes_from_instrument(instr: pretty_midi.Instrument, steps: float) -> Dict[float, List[pretty_midi.Note]]:
-    result: Dict[float, List[pretty_midi.Note]] = {}
-    for note in instr.notes:
-        if note.duration < steps:
-            continue
-        note_time = timespan_from_note(note)
-        time = get_multiple_number_greater_than(steps, note_time.start)
-        while note_time.contains(time):
-            if time not in result:
-                result[time] = [note]
-            else:
-                result[time].append(note)
-            time += steps
-    return result
-
-
-def get_notes_from_midi(mid: pretty_midi.PrettyMIDI, steps: float) -> Dict[float, List[InstrNote]]:
-    result: Dict[float, List[InstrNote]] = {}
-    for instr_index, instr in enumerate(mid.instruments):
-        extracted_notes = get_notes_from_instrument(instr, steps)
-        for time, notes in extracted_notes.items():
-            mapped = [InstrNote(instr_index, note.pitch) for note in notes]
-            if time not in result:
-                result[time] = mapped
-            else:
-                result[time].extend(mapped)
-    return result
-
-
-def split_array(array: List[any], count: int) -> List[List[any]]:
-    result = []
-    part_length = int(floor(len(array) / count))
-
-    for i in range(count):
-        offset = i * part_length
-        length = min(part_length, len(array) - offset)
-        part = [array[index + offset] for index in range(length)]
-        result.append(part)
-    return result
-
-
-def normalize_notelists(notes: List[InstrNote], desired_note_count: int) -> List[InstrNote]:
-    if len(notes) <= desired_note_count:
-        while len(notes) < desired_note_count:
-            notes.append(None)
-        return notes
-
-    result = get_base_pitches(notes, get_double_pitch(notes))
+# reduce_midi ignores notes shorter than one step
+QUANTIZE_RULES = {"skip_short": True}
+REDUCED_TEMPO = 80
+REDUCED_VELOCITY = 80
+
+PITCH_CLASS_COUNT = 12
+# the intervals of the two upper voices above the bass of a chord in close position, in the order they are tried:
+# the bass as root, as fifth and as third of a major, minor, diminished or augmented triad
+CHORD_INTERVALS = [
+    (3, 6), (3, 7), (4, 7), (4, 8),
+    (5, 8), (5, 9), (6, 9),
+    (3, 8), (3, 9), (4, 9)
+]
+
+
+def get_chord_table() -> np.ndarray:
+    # the intervals of the upper voices for every mask of the pitch classes above the bass, -1 if it is no chord
+    masks = np.arange(1 << PITCH_CLASS_COUNT)
+    result = np.full((len(masks), 2), -1, dtype=np.int64)
+    for intervals in reversed(CHORD_INTERVALS):
+        matches = ((masks >> intervals[0]) & 1).astype(bool) & ((masks >> intervals[1]) & 1).astype(bool)
+        result[matches] = intervals
     return result
 
 
-def get_note_values_from_midi(mid: pretty_midi.PrettyMIDI, steps: float, desired_note_count: int) -> List[
-    List[InstrNote]]:
-    notes = get_notes_from_midi(mid, steps)
-    result: List[List[InstrNote]] = []
-    time = 0
-    while len(notes) > 0:
-        if time in notes:
-            r = normalize_notelists(notes[time], desired_note_count)
-            if r is not None:
-                result.append(r)
-            else:
-                result.append([])
-            del notes[time]
-        else:
-            r = normalize_notelists([], desired_note_count)
-            if r is not None:
-                result.append(r)
-            else:
-                result.append([])
-        time += steps
-    return result
-
-
-def consume_further_notes(notes: List[List[InstrNote]], offset: int, pitch: InstrNote) -> int:
-    i = offset
-    count = 0
-    while i < len(notes):
-        if pitch in notes[i]:
-            count += 1
-            index: int = notes[i].index(pitch)
-            notes[i][index] = None
-            i += 1
-        else:
-            break
-    return count
-
-
-def create_midi(notes: List[List[InstrNote]], steps: float) -> pretty_midi.PrettyMIDI:
-    result = pretty_midi.PrettyMIDI(initial_tempo=80)
-    offset = 0
-    instr_values = set()
-    for step in notes:
-        for note in step:
-            if note is not None:
-                instr_values.add(note.instr)
-
-    instr_indices = dict()
+CHORD_TABLE = get_chord_table()
+
+
+def get_step_notes(grid: NoteGrid) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # one row for every step of every note, sorted by step and in the order of the notes within a step
+    valid = grid.last >= grid.first
+    first, lengths = grid.first[valid], grid.lengths[valid]
+    note_starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    step_indices = np.repeat(first, lengths) + np.arange(int(lengths.sum())) - note_starts
+    order = np.argsort(step_indices, kind="stable")
+    instruments = np.repeat(grid.instruments[valid], lengths)[order]
+    pitches = np.repeat(grid.pitches[valid].astype(np.int64), lengths)[order]
+    return step_indices[order], instruments, pitches
+
+
+def reduce_step_notes(step_indices: np.ndarray, instruments: np.ndarray, pitches: np.ndarray,
+                      desired_note_count: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # steps with too many notes become the bass, the two upper voices of their chord and the octave of the bass,
+    # each played by the instrument of the lowest note of its pitch class, steps without a chord become silent
+    counts = np.bincount(step_indices) if len(step_indices) > 0 else np.zeros(0, dtype=np.int64)
+    full = counts[step_indices] > desired_note_count
+    if not full.any():
+        return step_indices, instruments, pitches
+
+    order = np.flatnonzero(full)
+    order = order[np.lexsort((pitches[order], step_indices[order]))]
+    full_steps, step_starts = np.unique(step_indices[order], return_index=True)
+    bass = pitches[order][step_starts]
+    bass_instruments = instruments[order][step_starts]
+    step_numbers = np.repeat(np.arange(len(full_steps)), np.diff(np.append(step_starts, len(order))))
+    classes = (pitches[order] - bass[step_numbers]) % PITCH_CLASS_COUNT
+    masks = np.bitwise_or.reduceat(1 << classes, step_starts)
+    intervals = CHORD_TABLE[masks]
+    chord = intervals[:, 0] >= 0
+
+    # the lowest note of every pitch class of a step comes first
+    keys = step_numbers * PITCH_CLASS_COUNT + classes
+    class_keys, class_starts = np.unique(keys, return_index=True)
+    class_instruments = instruments[order][class_starts]
+    chord_numbers = np.flatnonzero(chord)
+    upper_instruments = [class_instruments[np.searchsorted(class_keys, chord_numbers * PITCH_CLASS_COUNT +
+                                                                       intervals[chord, voice])]
+                         for voice in range(2)]
+
+    chord_bass = bass[chord]
+    reduced_pitches = np.stack([chord_bass, chord_bass + intervals[chord, 0], chord_bass + intervals[chord, 1],
+                                chord_bass + PITCH_CLASS_COUNT], axis=1)
+    reduced_instruments = np.stack([bass_instruments[chord], upper_instruments[0], upper_instruments[1],
+                                    bass_instruments[chord]], axis=1)
+    reduced_steps = np.repeat(full_steps[chord], 4)
+
+    step_indices = np.concatenate([step_indices[~full], reduced_steps])
+    order = np.argsort(step_indices, kind="stable")
+    return (step_indices[order],
+            np.concatenate([instruments[~full], reduced_instruments.reshape(-1)])[order],
+            np.concatenate([pitches[~full], reduced_pitches.reshape(-1)])[order])
+
+
+def get_note_runs(step_indices: np.ndarray, instruments: np.ndarray, pitches: np.ndarray) -> \
+        Tuple[np.ndarray, np.ndarray]:
+    # the notes are given step by step, a note continues a run of its (instrument, pitch) track if the track
+    # has a note in the step before, the k-th equal note of a step continues the k-th run of the track
+    count = len(step_indices)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = np.lexsort((pitches, instruments, step_indices))
+    new_group = np.ones(count, dtype=bool)
+    new_group[1:] = ((np.diff(step_indices[order]) != 0) | (np.diff(instruments[order]) != 0) |
+                     (np.diff(pitches[order]) != 0))
+    group_starts = np.maximum.accumulate(np.where(new_group, np.arange(count), 0))
+    levels = np.empty(count, dtype=np.int64)
+    levels[order] = np.arange(count) - group_starts
+
+    order = np.lexsort((step_indices, levels, pitches, instruments))
+    new_run = np.ones(count, dtype=bool)
+    new_run[1:] = ((np.diff(instruments[order]) != 0) | (np.diff(pitches[order]) != 0) |
+                   (np.diff(levels[order]) != 0) | (np.diff(step_indices[order]) != 1))
+    run_starts = np.flatnonzero(new_run)
+    lengths = np.diff(np.append(run_starts, count))
+    # the runs in the order of their first note
+    first = order[run_starts]
+    run_order = np.argsort(first, kind="stable")
+    return first[run_order], lengths[run_order]
+
+
+def create_midi_notes_from_columns(step_indices: np.ndarray, instruments: np.ndarray, pitches: np.ndarray,
+                                   step_count: int, steps: float) -> Dict[str, np.ndarray]:
+    # the instruments are numbered in the order of a set of their values, which depends on the order they appear in
+    values, first_indices = np.unique(instruments, return_index=True)
+    instr_values = set(int(value) for value in values[np.argsort(first_indices)])
+    instr_indices = np.zeros(int(values.max()) + 1 if len(values) > 0 else 0, dtype=np.int64)
     for i, x in enumerate(instr_values):
         instr_indices[x] = i
 
-    instr = [pretty_midi.Instrument(i) for i in range(len(instr_values))]
-    # instr = pretty_midi.Instrument(0)
-    for moment_index in range(len(notes)):
-        for note in notes[moment_index]:
-            if note is not None:
-                total_pitch_length = consume_further_notes(notes, moment_index + 1, note) + 1
-                total_pitch_length *= steps
-                new_note = pretty_midi.Note(80, note.pitch, offset, offset + total_pitch_length)
-                instr[instr_indices[note.instr]].notes.append(new_note)
-                # instr.notes.append(note)
-        offset += steps
-    result.instruments.extend(instr)
-    # result.instruments.append(instr)
-    return result
+    first, lengths = get_note_runs(step_indices, instruments, pitches)
+    # the step times are summed up step by step
+    offsets = np.concatenate([[0.0], np.cumsum(np.full(max(step_count - 1, 0), steps))])
+    starts = offsets[step_indices[first]]
+    # the columns of write_midi_notes, one instrument with program i per instrument value
+    return {
+        "instruments": instr_indices[instruments[first]],
+        "pitches": pitches[first].astype(np.int64),
+        "velocities": np.full(len(first), REDUCED_VELOCITY, dtype=np.int64),
+        "starts": starts,
+        "ends": starts + lengths * steps,
+        "programs": np.arange(len(instr_values)),
+        "drums": np.zeros(len(instr_values), dtype=bool),
+        "names": np.array([""] * len(instr_values), dtype=str)
+    }
+
+
+def reduce_file(file: str, input_dir: str, output_dir: str,
+                note_count: int = 4,
+                time_steps: float = 0.125,
+                recursive: bool = False):
+    columns = load_midi_notes(file)
+    if columns is None:
+        return
+    click.echo("Processing {}...".format(file))
+    grid = get_note_grid_from_columns(columns, time_steps, **QUANTIZE_RULES)
+    step_indices, instruments, pitches = reduce_step_notes(*get_step_notes(grid), note_count)
+    new_notes = create_midi_notes_from_columns(step_indices, instruments, pitches, grid.step_count, time_steps)
+
+    name = get_file_name(file)
+    output = "{}_{}.mid".format(name, "reduced")
+    if not recursive:
+        output = os.path.join(output_dir, output)
+    else:
+        subdir = os.path.dirname(file)
+        subdir = os.path.relpath(subdir, input_dir)
+        subdir = get_and_create_folder_path(output_dir, subdir)
+        output = os.path.join(subdir, output)
+    click.echo("Saving {}...".format(output))
+    write_midi_notes(output, new_notes, initial_tempo=REDUCED_TEMPO)
 
 
 @click.command()
@@ -228,33 +178,38 @@ def create_midi(notes: List[List[InstrNote]], steps: float) -> pretty_midi.Prett
 @click.option("--note_count", "-count", default=4, type=int, show_default=True)
 @click.option("--time_steps", "-time", default=0.125, type=float, show_default=True)
 @click.option("--recursive", "-r", default=False, type=bool, show_default=True)
+@click.option("--jobs", "-j", default=1, type=int, show_default=True)
+@click.option("index_file", "--index", type=click.Path(dir_okay=False), default=None,
+              help="Corpus index file, created if missing.")
+@click.option("profile_dir", "--profile", type=click.Path(file_okay=False), default=None,
+              help="Folder for a pstats dump of the run.")
+@click.option("--profile_threshold", default=None, type=float,
+              help="Only keep the profiles of files taking longer than this many seconds.")
 def main(input_dir: str,
          output_dir: str,
          note_count: int = 4,
          time_steps: float = 0.125,
-         recursive: bool = False):
+         recursive: bool = False,
+         jobs: int = 1,
+         index_file: str = None,
+         profile_dir: str = None,
+         profile_threshold: float = None):
     click.echo(
         "Processing files from {} to {} with {} notes in {} steps...".format(input_dir, output_dir, note_count,
                                                                              time_steps))
 
-    midis = load_midis_with_files(input_dir, recursive)
-    for file, midi in midis:
-        click.echo("Processing {}...".format(file))
-        notes = get_note_values_from_midi(midi, time_steps, note_count)
-        new_midi = create_midi(notes, time_steps)
-
-        name = get_file_name(file)
-        output = "{}_{}.mid".format(name, "reduced")
-        if not recursive:
-            output = os.path.join(output_dir, output)
-        else:
-            subdir = os.path.dirname(file)
-            subdir = os.path.relpath(subdir, input_dir)
-            subdir = get_and_create_folder_path(output_dir, subdir)
-            output = os.path.join(subdir, output)
-        click.echo("Saving {}...".format(output))
-        new_midi.write(output)
-
+    index = CorpusIndex(index_file) if index_file is not None else None
+    if index is not None:
+        files = index.get_files(input_dir, "mid", recursive)
+    else:
+        files = get_files(input_dir, "mid", recursive)
+    metrics = Metrics(False, False, profile_dir, profile_threshold)
+    with metrics.stage("reduce"):
+        map_files(partial(reduce_file, input_dir=input_dir, output_dir=output_dir, note_count=note_count,
+                          time_steps=time_steps, recursive=recursive), files, jobs, metrics)
+
+    if index is not None:
+        index.save()
     click.echo("Done.")
 
 
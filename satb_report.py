@@ -0,0 +1,91 @@
+"""
+Columnar report of the analysis of check_satb and the filter applying thresholds to it
+The report holds the polyphony of every file and the pitch ranges and voice likelihoods of every instrument,
+so a different note_count or voice threshold only needs the report instead of the MIDI files
+"""
+
+import os
+from typing import List, Dict
+
+import click
+import numpy as np
+
+from files import write_manifest
+
+REPORT_VERSION = 1
+VOICE_THRESHOLD = 0.9
+
+
+def save_report(file: str, files: List[str], analyses: List[Dict[str, np.ndarray]], time_steps: float,
+                voices: List[str]) -> Dict[str, np.ndarray]:
+    # the columns of the instruments of all files follow each other, the offsets give the ones of a file
+    counts = [len(analysis["pitch_min"]) for analysis in analyses]
+    report = {
+        "version": np.array(REPORT_VERSION),
+        "time_steps": np.array(time_steps, dtype=np.float64),
+        "voices": np.array(voices, dtype=str),
+        "files": np.array([os.path.abspath(path) for path in files], dtype=str),
+        "max_polyphony": np.array([analysis["max_polyphony"] for analysis in analyses], dtype=np.int64),
+        "instrument_offsets": np.cumsum([0] + counts, dtype=np.int64)
+    }
+    for name, shape in [("pitch_min", ()), ("pitch_max", ()), ("likelihoods", (len(voices),)),
+                        ("filtered_polyphony", ())]:
+        columns = [analysis[name] for analysis in analyses]
+        report[name] = np.concatenate(columns) if len(columns) > 0 else np.zeros((0,) + shape)
+    with open(file, "wb") as f:
+        np.savez(f, **report)
+    return report
+
+
+def load_report(file: str) -> Dict[str, np.ndarray]:
+    with open(file, "rb") as f:
+        with np.load(f, allow_pickle=False) as npz:
+            if "version" not in npz or int(npz["version"]) != REPORT_VERSION:
+                raise ValueError("{} is not an analysis report of version {}".format(file, REPORT_VERSION))
+            return {name: npz[name] for name in npz.files}
+
+
+def get_accepted(report: Dict[str, np.ndarray], note_count: int = 4,
+                 threshold: float = VOICE_THRESHOLD) -> np.ndarray:
+    # the same decision as analyse_file, the instruments above the threshold are always the most likely ones
+    # of a file, whose polyphony is in filtered_polyphony at their count - 1
+    offsets = report["instrument_offsets"]
+    file_count = len(report["files"])
+    file_index = np.repeat(np.arange(file_count), np.diff(offsets))
+    is_voice = report["likelihoods"].max(axis=1) > threshold
+    voice_counts = np.bincount(file_index[is_voice], minlength=file_count)
+
+    polyphony = report["max_polyphony"].copy()
+    with_voices = voice_counts > 0
+    polyphony[with_voices] = report["filtered_polyphony"][offsets[:-1][with_voices] + voice_counts[with_voices] - 1]
+    return polyphony <= note_count
+
+
+@click.command()
+@click.option("report_file", "--input", "-i", type=click.Path(exists=True, dir_okay=False), required=True,
+              help="Report written by check_satb --analysis.")
+@click.option("output_file", "--output", "-o", type=click.Path(dir_okay=False), default=None,
+              help="Manifest of the accepted files, printed if missing.")
+@click.option("--note_count", "-count", default=4, type=int, show_default=True)
+@click.option("--threshold", default=VOICE_THRESHOLD, type=float, show_default=True,
+              help="Voice likelihood of the instruments counted as voices.")
+def main(report_file: str,
+         output_file: str = None,
+         note_count: int = 4,
+         threshold: float = VOICE_THRESHOLD):
+    try:
+        report = load_report(report_file)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--input")
+    accepted = report["files"][get_accepted(report, note_count, threshold)]
+    if output_file is None:
+        for file in accepted:
+            click.echo(file)
+        return
+    write_manifest(accepted, output_file)
+    click.echo("Accepted {} of {} files with {} notes, saved to {}.".format(len(accepted), len(report["files"]),
+                                                                         note_count, output_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,22 +5,30 @@ Separation happens evenly distributed
 
 import os
 import random
-import shutil
+from functools import partial
 
 import click
 
-from common import *
+from files import *
+from metrics import Metrics
 
 
-def get_sets(folder: str) -> List[List[str]]:
-    files = get_files(folder, "mid")
+def get_sets(folder: str, seed: int = None) -> List[List[str]]:
+    return split_sets(sorted(get_stage_files(folder, "mid")), seed)
+
+
+def split_sets(files: List[str], seed: int = None) -> List[List[str]]:
+    files = list(files)
     count = len(files)
     part_length = int(count / 3)
     if count % 3 != 0:
         part_length += 1
 
     result = []
-    random.shuffle(files)
+    if seed is None:
+        random.shuffle(files)
+    else:
+        random.Random(seed).shuffle(files)
     i = 0
     tmp = []
     for file in files:
@@ -35,29 +43,47 @@ def get_sets(folder: str) -> List[List[str]]:
     return result
 
 
-def copy_file(origin: str, dest_folder: str):
-    shutil.copy(origin, dest_folder)
+def copy_file(origin: str, dest_folder: str, link_mode: str = "copy"):
+    link_file(origin, os.path.join(dest_folder, os.path.basename(origin)), link_mode)
 
 
-def copy_sets(sets: List[List[str]], folder: str):
+def copy_sets(sets: List[List[str]], folder: str, link_mode: str = "copy", metrics: Metrics = None):
     subfolders = ["train", "test", "valid"]
     subfolders = [os.path.join(folder, subfolder) for subfolder in subfolders]
     for i, subfolder in enumerate(subfolders):
+        if link_mode == "manifest":
+            click.echo("Listing {} files in {}{}".format(len(sets[i]), subfolder, MANIFEST_EXTENSION))
+            write_manifest(sets[i], subfolder + MANIFEST_EXTENSION)
+            if metrics is not None:
+                metrics.add_listed_files(sets[i])
+            continue
         click.echo("Copying {} files to {}".format(len(sets[i]), subfolder))
         if not os.path.exists(subfolder):
             os.mkdir(subfolder)
-        for file in sets[i]:
-            copy_file(file, subfolder)
+        map_files(partial(copy_file, dest_folder=subfolder, link_mode=link_mode), sets[i], 1, metrics)
 
 
 @click.command()
-@click.option("input_dir", "--input", "-i", type=click.Path(exists=True, file_okay=False), required=True)
+@click.option("input_dir", "--input", "-i", type=click.Path(exists=True), required=True,
+              help="Folder or manifest of the files.")
 @click.option("output_dir", "--output", "-o", type=click.Path(exists=True, file_okay=False), required=True)
+@click.option("--seed", default=None, type=int)
+@click.option("--link_mode", default="copy", type=click.Choice(LINK_MODES), show_default=True)
+@click.option("profile_dir", "--profile", type=click.Path(file_okay=False), default=None,
+              help="Folder for a pstats dump of the run.")
+@click.option("--profile_threshold", default=None, type=float,
+              help="Only keep the profiles of files taking longer than this many seconds.")
 def main(input_dir: str,
-         output_dir: str):
+         output_dir: str,
+         seed: int = None,
+         link_mode: str = "copy",
+         profile_dir: str = None,
+         profile_threshold: float = None):
     click.echo(
         "Processing files from {} to {}...".format(input_dir, output_dir))
-    copy_sets(get_sets(input_dir), output_dir)
+    metrics = Metrics(False, False, profile_dir, profile_threshold)
+    with metrics.stage("separate"):
+        copy_sets(get_sets(input_dir, seed), output_dir, link_mode, metrics)
     click.echo("Done.")
 
 
@@ -5,36 +5,111 @@ Splitting MIDI files into smaller ones with random lengths between min_length an
 import math
 import os
 import random
-from typing import List
+from functools import partial
+from typing import List, Dict, Tuple
 
 import click
 import pretty_midi
 
 from common import *
+from metrics import Metrics
 
 
-def create_sub_midi(midi: pretty_midi.PrettyMIDI, start_time: float, end_time: float) -> pretty_midi.PrettyMIDI:
+class InstrumentIndex:
+    def __init__(self, instr: pretty_midi.Instrument):
+        self.instr = instr
+        self.starts = np.array([note.start for note in instr.notes], dtype=np.float64)
+        self.ends = np.array([note.end for note in instr.notes], dtype=np.float64)
+        self.order = np.argsort(self.starts, kind="stable")
+        self.sorted_starts = self.starts[self.order]
+        # the latest end up to every sorted note, so the first note reaching into a part can be searched as well
+        self.max_ends = np.maximum.accumulate(self.ends[self.order]) if len(self.order) > 0 else self.ends
+
+    def get_overlapping(self, start_time: float, end_time: float) -> np.ndarray:
+        first = np.searchsorted(self.max_ends, start_time, side="left")
+        last = np.searchsorted(self.sorted_starts, end_time, side="left")
+        candidates = self.order[first:last]
+        return np.sort(candidates[self.ends[candidates] >= start_time])
+
+
+def get_midi_index(midi: pretty_midi.PrettyMIDI) -> List[InstrumentIndex]:
+    return [InstrumentIndex(instr) for instr in midi.instruments]
+
+
+def create_sub_midi(midi: pretty_midi.PrettyMIDI, start_time: float, end_time: float,
+                    index: List[InstrumentIndex] = None) -> pretty_midi.PrettyMIDI:
+    if index is None:
+        index = get_midi_index(midi)
     result = pretty_midi.PrettyMIDI()
-    part_timespan = Timespan(start_time, end_time)
 
-    for instr in midi.instruments:
+    for instr_index in index:
+        instr = instr_index.instr
         subInstr = pretty_midi.Instrument(instr.program, instr.is_drum, instr.name)
-        note: pretty_midi.Note
-        for note in instr.notes:
-            note_timespan = timespan_from_note(note)
-            sub_timespan = part_timespan.get_contained(note_timespan)
-            if sub_timespan is not None:
-                sub_timespan.subtract(start_time)
-                subNote = pretty_midi.Note(note.velocity, note.pitch, sub_timespan.start, sub_timespan.end)
-                subInstr.notes.append(subNote)
+        selected = instr_index.get_overlapping(start_time, end_time)
+        # same clipping as Timespan.get_contained and Timespan.subtract
+        starts = np.maximum(np.maximum(instr_index.starts[selected], start_time) - start_time, 0)
+        ends = np.maximum(np.minimum(instr_index.ends[selected], end_time) - start_time, 0)
+        for note_index, start, end in zip(selected.tolist(), starts.tolist(), ends.tolist()):
+            note = instr.notes[note_index]
+            subInstr.notes.append(pretty_midi.Note(note.velocity, note.pitch, start, end))
         result.instruments.append(subInstr)
     return result
 
 
-def split_midi(midi: pretty_midi.PrettyMIDI,
-               min_length: float = 15,
-               max_length: float = 90) -> List[pretty_midi.PrettyMIDI]:
-    total_length = midi.get_end_time()
+def create_sub_notes(notes: Dict[str, np.ndarray], start_time: float, end_time: float) -> Dict[str, np.ndarray]:
+    # same notes and clipping as create_sub_midi, on the columns of load_midi_notes
+    selected = (notes["starts"] < end_time) & (notes["ends"] >= start_time)
+    result = dict(notes)
+    result["instruments"] = notes["instruments"][selected]
+    result["pitches"] = notes["pitches"][selected]
+    result["velocities"] = notes["velocities"][selected]
+    result["starts"] = np.maximum(np.maximum(notes["starts"][selected], start_time) - start_time, 0)
+    result["ends"] = np.maximum(np.minimum(notes["ends"][selected], end_time) - start_time, 0)
+    del result["end_time"]
+    return result
+
+
+def get_part_tick_scale() -> float:
+    # parts are written with the PrettyMIDI defaults, so their times are rounded to these ticks on disk
+    return pretty_midi.PrettyMIDI().tick_to_time(1)
+
+
+def create_sub_grid(grid: NoteGrid, start_time: float, end_time: float, tick_scale: float = None) -> NoteGrid:
+    # same notes and clipping as create_sub_midi, taken from the note columns of the whole piece
+    selected = (grid.starts < end_time) & (grid.ends >= start_time)
+    instruments = grid.instruments[selected]
+    pitches = grid.pitches[selected]
+    starts = np.maximum(grid.starts[selected], start_time) - start_time
+    ends = np.minimum(grid.ends[selected], end_time) - start_time
+
+    if tick_scale is not None:
+        # emulate writing and reading the part: times snap to ticks and every instrument lists its notes
+        # in note off order. A note without length is only closed by the next note off of its pitch.
+        start_ticks = np.round(starts / tick_scale)
+        end_ticks = np.round(ends / tick_scale)
+        closed_ticks = end_ticks.copy()
+        for index in np.flatnonzero(end_ticks == start_ticks):
+            later_offs = end_ticks[(instruments == instruments[index]) & (pitches == pitches[index]) &
+                                   (end_ticks > start_ticks[index])]
+            closed_ticks[index] = later_offs.min() if len(later_offs) > 0 else start_ticks[index]
+        end_ticks = closed_ticks
+        order = np.lexsort((start_ticks, pitches, end_ticks, instruments))
+        order = order[end_ticks[order] > start_ticks[order]]
+        instruments = instruments[order]
+        pitches = pitches[order]
+        starts = start_ticks[order] * tick_scale
+        ends = end_ticks[order] * tick_scale
+
+    return NoteGrid(instruments, pitches, starts, ends, grid.instrument_count, grid.steps,
+                    grid.skip_short, grid.legacy_onset)
+
+
+def get_part_times(total_length: float,
+                   min_length: float = 15,
+                   max_length: float = 90,
+                   rng: random.Random = None) -> List[Tuple[float, float]]:
+    if rng is None:
+        rng = random
     # part_length = total_length / optimal_part_count
     # part_length = max(min_length, part_length)
     # part_length = min(max_length, part_length)
@@ -43,45 +118,90 @@ def split_midi(midi: pretty_midi.PrettyMIDI,
     result = []
     time = 0.0
     while time < total_length:
-        tmp_length = random.randrange(min_length, max_length)
+        tmp_length = rng.randrange(min_length, max_length)
         part_end = min(total_length, time + tmp_length)
-        part = create_sub_midi(midi, time, part_end)
-        result.append(part)
+        result.append((time, part_end))
         time += tmp_length
     return result
 
 
+def split_midi(midi: pretty_midi.PrettyMIDI,
+               min_length: float = 15,
+               max_length: float = 90,
+               rng: random.Random = None) -> List[pretty_midi.PrettyMIDI]:
+    index = get_midi_index(midi)
+    return [create_sub_midi(midi, start_time, end_time, index)
+            for start_time, end_time in get_part_times(midi.get_end_time(), min_length, max_length, rng)]
+
+
+def get_file_rng(file: str, seed: int) -> random.Random:
+    # every file gets its own generator, so the parts do not depend on the processing order
+    return random.Random("{}:{}".format(seed, os.path.basename(file)))
+
+
+def split_file(file: str, output_dir: str,
+               min_length: float = 15,
+               max_length: float = 90,
+               seed: int = 0) -> int:
+    notes = load_midi_notes(file)
+    if notes is None:
+        return 0
+
+    click.echo("Processing {}...".format(file))
+    part_times = get_part_times(float(notes["end_time"]), min_length, max_length, get_file_rng(file, seed))
+    name = get_file_name(file)
+    click.echo("Saving {}...".format(file))
+    for i, (start_time, end_time) in enumerate(part_times):
+        output = "{}_{}.mid".format(name, i)
+        output = os.path.join(output_dir, output)
+        # the notes go straight to the file, the bytes are the same as writing create_sub_midi
+        write_midi_notes(output, create_sub_notes(notes, start_time, end_time))
+    return len(part_times)
+
+
 def split_all_midis_from_dir(dir: str, output_dir: str,
                              min_length: float = 15,
-                             max_length: float = 90):
+                             max_length: float = 90,
+                             seed: int = None,
+                             jobs: int = 1,
+                             metrics: Metrics = None):
+    if seed is None:
+        seed = random.getrandbits(32)
+
     click.echo("Loading files from {}...".format(dir))
-    midis = load_midis_with_files(dir)
+    files = get_stage_files(dir, "mid")
 
     click.echo("Processing data...")
-    for file, midi in midis:
-        click.echo("Processing {}...".format(file))
-        parts = split_midi(midi, min_length, max_length)
-        name = get_file_name(file)
-        click.echo("Saving {}...".format(file))
-        for i in range(len(parts)):
-            output = "{}_{}.mid".format(name, i)
-            output = os.path.join(output_dir, output)
-            parts[i].write(output)
+    map_files(partial(split_file, output_dir=output_dir, min_length=min_length, max_length=max_length, seed=seed),
+              files, jobs, metrics)
 
 
 @click.command()
-@click.option("input_dir", "--input", "-i", type=click.Path(exists=True, file_okay=False), required=True)
+@click.option("input_dir", "--input", "-i", type=click.Path(exists=True), required=True,
+              help="Folder or manifest of the files.")
 @click.option("output_dir", "--output", "-o", type=click.Path(exists=True, file_okay=False), required=True)
 @click.option("--min_length", "-min", default=15, type=float, show_default=True)
 @click.option("--max_length", "-max", default=90, type=float, show_default=True)
+@click.option("--seed", default=None, type=int)
+@click.option("--jobs", "-j", default=1, type=int, show_default=True)
+@click.option("profile_dir", "--profile", type=click.Path(file_okay=False), default=None,
+              help="Folder for a pstats dump of the run.")
+@click.option("--profile_threshold", default=None, type=float,
+              help="Only keep the profiles of files taking longer than this many seconds.")
 def main(input_dir: str,
          output_dir: str,
          min_length: float = 15,
-         max_length: float = 90):
+         max_length: float = 90,
+         seed: int = None,
+         jobs: int = 1,
+         profile_dir: str = None,
+         profile_threshold: float = None):
     click.echo(
         "Processing files from {} to {} with min: {}, max: {}...".format(input_dir, output_dir,
                                                                          min_length, max_length))
-    split_all_midis_from_dir(input_dir, output_dir, min_length, max_length)
+    metrics = Metrics(False, False, profile_dir, profile_threshold)
+    with metrics.stage("split"):
+        split_all_midis_from_dir(input_dir, output_dir, min_length, max_length, seed, jobs, metrics)
     click.echo("Done.")
 
 
@@ -0,0 +1,91 @@
+"""
+Splitting quantized pieces into windows with random lengths between min_length and max_length
+Only an index of (piece, start_step, end_step) rows is written, so the split lengths can be changed
+without running the filter and the quantization again
+"""
+
+import os
+import random
+from typing import List, Tuple
+
+import click
+import numpy as np
+
+import process_midi as process
+import separate_midis as sep
+from split_midi import get_file_rng
+
+
+def get_step_windows(step_count: int,
+                     time_steps: float,
+                     min_length: float = 15,
+                     max_length: float = 90,
+                     rng: random.Random = None,
+                     overlap: float = 0) -> List[Tuple[int, int]]:
+    if rng is None:
+        rng = random
+    if overlap >= min_length:
+        raise ValueError("overlap of {}s has to be shorter than min_length of {}s".format(overlap, min_length))
+    overlap_steps = int(round(overlap / time_steps))
+
+    result = []
+    start = 0
+    while start < step_count:
+        length = int(round(rng.randrange(min_length, max_length) / time_steps))
+        result.append((start, min(step_count, start + length)))
+        start += max(1, length - overlap_steps)
+    return result
+
+
+def save_pieces_info(folder: str, names: List[str], time_steps: float):
+    np.save(os.path.join(folder, "pieces_names.npy"), np.array(names, dtype=str))
+    np.save(os.path.join(folder, "time_steps.npy"), np.array(time_steps, dtype=np.float64))
+
+
+def split_windows(folder: str,
+                  min_length: float = 15,
+                  max_length: float = 90,
+                  seed: int = None,
+                  overlap: float = 0) -> List[np.ndarray]:
+    pieces = process.open_ragged_notes(folder, names=["pieces"])["pieces"]
+    names = np.load(os.path.join(folder, "pieces_names.npy"))
+    time_steps = float(np.load(os.path.join(folder, "time_steps.npy")))
+
+    split_seed = random.getrandbits(32) if seed is None else seed
+    windows = {}
+    for piece, (name, length) in enumerate(zip(names, pieces.lengths)):
+        rng = get_file_rng("{}.mid".format(name), split_seed)
+        for i, (start, end) in enumerate(get_step_windows(int(length), time_steps, min_length, max_length,
+                                                          rng, overlap)):
+            windows["{}_{}.mid".format(name, i)] = (piece, start, end)
+
+    result = []
+    for name, window_set in zip(["train", "test", "valid"], sep.split_sets(sorted(windows), seed)):
+        set_windows = np.array([windows[window] for window in window_set], dtype=np.int64).reshape((-1, 3))
+        np.save(os.path.join(folder, "{}_windows.npy".format(name)), set_windows)
+        result.append(set_windows)
+    return result
+
+
+@click.command()
+@click.option("input_dir", "--input", "-i", type=click.Path(exists=True, file_okay=False), required=True, prompt=True)
+@click.option("--min_length", "-min", default=15, type=float, show_default=True)
+@click.option("--max_length", "-max", default=90, type=float, show_default=True)
+@click.option("--overlap", default=0, type=float, show_default=True, help="Seconds shared by following windows.")
+@click.option("--seed", default=None, type=int)
+def main(input_dir: str,
+         min_length: float = 15,
+         max_length: float = 90,
+         overlap: float = 0,
+         seed: int = None):
+    if overlap >= min_length:
+        raise click.BadParameter("has to be shorter than --min_length", param_hint="--overlap")
+    click.echo("Splitting pieces from {} into windows of {} to {}...".format(input_dir, min_length, max_length))
+    sets = split_windows(input_dir, min_length, max_length, seed, overlap)
+    for name, windows in zip(["train", "test", "valid"], sets):
+        click.echo("{}: {} windows".format(name, len(windows)))
+    click.echo("Done.")
+
+
+if __name__ == '__main__':
+    main()